@@ -1,8 +1,12 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Request, Response, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.datastructures import Headers
+from starlette.concurrency import run_in_threadpool
 from motor.motor_asyncio import AsyncIOMotorClient
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
@@ -10,14 +14,23 @@ from slowapi.errors import RateLimitExceeded
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError
+from typing import List, Optional, Literal
 import uuid
 from datetime import datetime, timezone, timedelta
+from email.utils import format_datetime, parsedate_to_datetime
 from zoneinfo import ZoneInfo
 import csv
-from pymongo import UpdateOne
+import html
+import re
+import codecs
+import json
+import base64
+import hashlib
+from pymongo import UpdateOne, InsertOne, DeleteOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import io
+import zlib
 import jwt
 import bcrypt
 import cloudinary
@@ -26,6 +39,18 @@ from cloudinary.exceptions import Error as CloudinaryError
 from cloudinary.utils import cloudinary_url
 import asyncio
 import certifi
+import numpy as np
+import pandas as pd
+import time
+from collections import OrderedDict
+
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:  # Optional; the stdlib encoder is used without it
+    orjson = None
+    FastJSONResponse = JSONResponse
+from concurrent.futures import ThreadPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -55,7 +80,42 @@ if not JWT_SECRET:
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
-app = FastAPI()
+# Authenticated-user cache (per process; bounded staleness across workers)
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', '2048'))
+# Running counters behind the dashboard (write-through from this worker)
+STATS_CACHE_TTL_SECONDS = float(os.environ.get('STATS_CACHE_TTL_SECONDS', '60'))
+
+# Password hashing (bcrypt runs off the event loop in a bounded pool)
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+BCRYPT_MAX_WORKERS = int(os.environ.get('BCRYPT_MAX_WORKERS', '2'))
+BCRYPT_MAX_QUEUE = int(os.environ.get('BCRYPT_MAX_QUEUE', '64'))
+
+# Pagination
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '5000'))
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NDJSON_FLUSH_DOCS = int(os.environ.get('NDJSON_FLUSH_DOCS', '100'))
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', '500'))
+IMPORT_BATCH_ROWS = int(os.environ.get('IMPORT_BATCH_ROWS', '1000'))
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', '100'))
+
+# Gamification side effects (applied after the response by a background worker)
+SIDE_EFFECT_BATCH_SIZE = int(os.environ.get('SIDE_EFFECT_BATCH_SIZE', '50'))
+SIDE_EFFECT_MAX_ATTEMPTS = int(os.environ.get('SIDE_EFFECT_MAX_ATTEMPTS', '5'))
+SIDE_EFFECT_DRAIN_TIMEOUT = float(os.environ.get('SIDE_EFFECT_DRAIN_TIMEOUT', '10'))
+SIDE_EFFECT_OUTBOX = os.environ.get('SIDE_EFFECT_OUTBOX', '').strip().lower() in ('1', 'true', 'yes')
+SIDE_EFFECT_OUTBOX_STALE_SECONDS = int(os.environ.get('SIDE_EFFECT_OUTBOX_STALE_SECONDS', '300'))
+
+# Delta sync (per-user change sequence + tombstones for /api/preload)
+SYNC_CURSOR_OVERLAP_SECONDS = int(os.environ.get('SYNC_CURSOR_OVERLAP_SECONDS', '30'))
+SYNC_TOMBSTONE_TTL_DAYS = int(os.environ.get('SYNC_TOMBSTONE_TTL_DAYS', '30'))
+
+# Responses (gzip threshold in bytes, and whether list reads go through response_model)
+GZIP_MINIMUM_SIZE = int(os.environ.get('GZIP_MINIMUM_SIZE', '1024'))
+GZIP_COMPRESS_LEVEL = int(os.environ.get('GZIP_COMPRESS_LEVEL', '6'))
+RESPONSE_MODEL_VALIDATION = os.environ.get('RESPONSE_MODEL_VALIDATION', 'true').strip().lower() in ('1', 'true', 'yes')
+
+app = FastAPI(default_response_class=FastJSONResponse)
 limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -165,6 +225,26 @@ class NoteUpdate(BaseModel):
     categories: Optional[List[str]] = None
     is_favorite: Optional[bool] = None
     parent_id: Optional[str] = None
+    base_revision: Optional[int] = None  # Reject with 409 if the content has moved on
+
+class NotePatchOp(BaseModel):
+    # Offsets are in UTF-16 code units, matching JavaScript string indexes
+    start: int = Field(ge=0)
+    delete: int = Field(0, ge=0)
+    insert: str = ""
+
+class NoteContentPatch(BaseModel):
+    base_revision: int = Field(ge=0)
+    ops: List[NotePatchOp] = Field(min_length=1)
+
+class NoteMove(BaseModel):
+    parent_id: Optional[str] = None  # None moves the note to the top level
+
+class NotePatchResponse(BaseModel):
+    id: str
+    revision: int
+    length: int
+    updated_at: str
 
 class UploadResponse(BaseModel):
     url: str
@@ -185,6 +265,8 @@ class NoteResponse(BaseModel):
     tags: List[str] = []
     is_favorite: bool
     parent_id: Optional[str] = None
+    ancestors: List[str] = []
+    revision: int = 0
     created_at: str
     updated_at: str
 
@@ -197,6 +279,8 @@ class NoteSummaryResponse(BaseModel):
     tags: List[str] = []
     is_favorite: bool
     parent_id: Optional[str] = None
+    ancestors: List[str] = []
+    revision: int = 0
     created_at: str
     updated_at: str
 
@@ -239,10 +323,11 @@ class FocusSessionResponse(BaseModel):
 
 class DailyActivityResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    date: str
-    tasks_completed: int
-    focus_time: int
-    notes_created: int
+    date: str  # For week/month/year buckets, the first day of the period
+    period: Optional[str] = None
+    tasks_completed: int = 0
+    focus_time: int = 0
+    notes_created: int = 0
 
 class AchievementResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -290,14 +375,155 @@ class HabitResponse(BaseModel):
 class HabitReorder(BaseModel):
     habit_ids: List[str]
 
-# ============ HELPERS ============
+class ReorderMove(BaseModel):
+    id: str
+    order: int
+
+class TaskReorder(BaseModel):
+    task_ids: List[str] = []
+    moves: List[ReorderMove] = []
+
+class SheetReorder(BaseModel):
+    sheet_ids: List[str] = []
+    moves: List[ReorderMove] = []
+
+class RowReorder(BaseModel):
+    row_ids: List[str] = []
+    moves: List[ReorderMove] = []
+
+class SearchResult(BaseModel):
+    kind: Literal["note", "task"]
+    id: str
+    title: str
+    snippet: str = ""
+    score: float
+    tags: List[str] = []
+    status: Optional[str] = None
+    parent_id: Optional[str] = None
+    updated_at: Optional[str] = None
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+class BatchOperation(BaseModel):
+    op: Literal["create", "update", "delete"]
+    collection: Literal["tasks", "notes", "habits", "budget_rows"]
+    id: Optional[str] = None
+    sheet_id: Optional[str] = None  # Required when creating budget rows
+    data: dict = {}
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+# ============ HELPERS ============
 
-def verify_password(password: str, hashed: str) -> bool:
+class TTLCache:
+    """Small in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def update(self, key: str, fields: dict):
+        """Merge fields into a cached entry without extending its lifetime."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def invalidate(self, key: str):
+        self._entries.pop(key, None)
+
+user_cache = TTLCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
+stats_cache = TTLCache(USER_CACHE_MAX_SIZE, STATS_CACHE_TTL_SECONDS)
+
+class PasswordHasher:
+    """Runs bcrypt work in a bounded thread pool so logins never block the event loop.
+
+    At most `max_workers` hashes run at once; up to `max_queue` more may wait
+    for a slot before callers are turned away with a 503. Pool stats are only
+    logged (on the 1st, 10th, 100th... rejection and at shutdown), never served.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, rounds: int):
+        self.rounds = rounds
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._slots = asyncio.Semaphore(max_workers)
+        self.max_workers = max_workers
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def _run(self, fn, *args):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            if str(self.rejected).strip("0") == "1":
+                logger.warning(f"Password hashing pool is full, turning logins away: {self.stats()}")
+            raise HTTPException(status_code=503, detail="Authentication is busy, please retry shortly")
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_bcrypt_hash, password, self.rounds)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(_bcrypt_verify, password, hashed)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "queue_depth": self.waiting,
+            "in_flight": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        logger.info(f"Password hashing pool stats: {self.stats()}")
+        self._executor.shutdown(wait=False)
+
+def _bcrypt_hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+def _bcrypt_verify(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+password_hasher = PasswordHasher(BCRYPT_MAX_WORKERS, BCRYPT_MAX_QUEUE, BCRYPT_ROUNDS)
+
+async def hash_password(password: str) -> str:
+    return await password_hasher.hash(password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await password_hasher.verify(password, hashed)
+
 def create_token(user_id: str, email: str) -> str:
     """Create a JWT access token. Uses UTC for expiration (PyJWT requires UTC)."""
     payload = {
@@ -316,10 +542,14 @@ async def get_current_user(credentials: Optional[HTTPAuthorizationCredentials] =
         user_id = payload.get("sub")
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await db.users.find_one({"id": user_id}, {"_id": 0})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            user_cache.set(user_id, user)
+        # Hand out a copy so route handlers can't mutate the cached principal
+        return dict(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
@@ -336,14 +566,23 @@ def calculate_level(xp: int) -> int:
         return 50 + (xp - 16500) // 1000
 
 async def add_xp(user_id: str, xp_amount: int):
-    user = await db.users.find_one({"id": user_id}, {"_id": 0})
-    if user:
-        new_xp = user.get("total_xp", 0) + xp_amount
-        new_level = calculate_level(new_xp)
-        await db.users.update_one(
-            {"id": user_id},
-            {"$set": {"total_xp": new_xp, "current_level": new_level}}
-        )
+    """Atomically award XP; the level is only written when a boundary is crossed."""
+    if xp_amount <= 0:
+        return
+    user = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$inc": {"total_xp": xp_amount}},
+        projection={"_id": 0, "total_xp": 1, "current_level": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not user:
+        return
+    new_xp = user.get("total_xp", 0)
+    new_level = calculate_level(new_xp)
+    if new_level != user.get("current_level", 1):
+        # $max keeps concurrent awards from ever moving the level backwards
+        await db.users.update_one({"id": user_id}, {"$max": {"current_level": new_level}})
+    user_cache.update(user_id, {"total_xp": new_xp, "current_level": max(new_level, user.get("current_level", 1))})
 
 async def update_streak(user_id: str):
     today = datetime.now(ZoneInfo("Asia/Kolkata")).strftime("%Y-%m-%d")
@@ -373,17 +612,19 @@ async def update_streak(user_id: str):
         
         longest_streak = max(longest_streak, current_streak)
         
-        await db.users.update_one(
-            {"id": user_id},
-            {"$set": {
-                "current_streak": current_streak,
-                "longest_streak": longest_streak,
-                "last_streak_date": today
-            }}
-        )
-
-async def update_daily_activity(user_id: str, field: str, increment: int = 1):
-    """Atomically increment a daily activity counter, creating the document if needed."""
+        streak_fields = {
+            "current_streak": current_streak,
+            "longest_streak": longest_streak,
+            "last_streak_date": today
+        }
+        await db.users.update_one({"id": user_id}, {"$set": streak_fields})
+        user_cache.update(user_id, streak_fields)
+
+async def update_daily_activity(user_id: str, field: str, increment: int = 1) -> str:
+    """Atomically increment a daily activity counter, creating the document if needed.
+
+    Returns the day that was incremented so the rollups can follow.
+    """
     today = datetime.now(ZoneInfo("Asia/Kolkata")).strftime("%Y-%m-%d")
     # Atomic upsert: avoids race condition where two concurrent requests
     # both see no existing doc and try to insert, violating the unique index.
@@ -399,6 +640,136 @@ async def update_daily_activity(user_id: str, field: str, increment: int = 1):
         },
         upsert=True,
     )
+    return today
+
+# --- Activity rollups ---
+# activity_rollups holds week, month and year buckets plus one lifetime
+# document per user, kept in step with daily_activity, so heatmaps over long
+# ranges and lifetime totals read a fixed handful of documents. Buckets are
+# never incremented: each one is recomputed from what it covers, and every
+# write is guarded by the bucket's `rev`, so a write based on a stale read is
+# retried instead of landing, and replays or concurrent rebuilds can't count
+# anything twice.
+
+ACTIVITY_FIELDS = ("tasks_completed", "focus_time", "notes_created")
+ROLLUP_GRANULARITIES = ("week", "month", "year")
+ROLLUP_REBUILD_ATTEMPTS = 5
+
+def activity_periods(day: str) -> List[tuple]:
+    """(granularity, period, first day) buckets a YYYY-MM-DD day falls into."""
+    date = datetime.strptime(day, "%Y-%m-%d").date()
+    iso_year, iso_week, iso_weekday = date.isocalendar()
+    return [
+        ("week", f"{iso_year}-W{iso_week:02d}", (date - timedelta(days=iso_weekday - 1)).isoformat()),
+        ("month", day[:7], f"{day[:7]}-01"),
+        ("year", day[:4], f"{day[:4]}-01-01"),
+    ]
+
+def period_end(granularity: str, start: str) -> str:
+    """First day after the bucket starting on `start`."""
+    date = datetime.strptime(start, "%Y-%m-%d").date()
+    if granularity == "week":
+        return (date + timedelta(days=7)).isoformat()
+    if granularity == "month":
+        return (date.replace(day=28) + timedelta(days=4)).replace(day=1).isoformat()
+    return f"{date.year + 1}-01-01"
+
+async def rebuild_activity_rollups(user_id: str) -> dict:
+    """Recompute a user's rollups from daily_activity; returns the lifetime totals.
+
+    Each bucket is overwritten only if its `rev` still matches what was seen
+    before daily_activity was read. A bucket that moved in the meantime was
+    recomputed from days this read may predate, so the rebuild starts over.
+    """
+    for _ in range(ROLLUP_REBUILD_ATTEMPTS):
+        seen = {
+            (doc["granularity"], doc["period"]): doc.get("rev", 0)
+            async for doc in db.activity_rollups.find({"user_id": user_id}, {"_id": 0, "granularity": 1, "period": 1, "rev": 1})
+        }
+        lifetime = {field: 0 for field in ACTIVITY_FIELDS}
+        buckets: dict = {("lifetime", "all"): lifetime}
+        async for daily in db.daily_activity.find({"user_id": user_id}, {"_id": 0, "date": 1, **{f: 1 for f in ACTIVITY_FIELDS}}):
+            for granularity, period, start in activity_periods(daily["date"]):
+                bucket = buckets.setdefault((granularity, period), {"date": start, **{field: 0 for field in ACTIVITY_FIELDS}})
+                for field in ACTIVITY_FIELDS:
+                    bucket[field] += daily.get(field, 0)
+            for field in ACTIVITY_FIELDS:
+                lifetime[field] += daily.get(field, 0)
+
+        operations = []
+        for (granularity, period), values in buckets.items():
+            key = {"user_id": user_id, "granularity": granularity, "period": period}
+            if (granularity, period) in seen:
+                operations.append(UpdateOne({**key, "rev": seen[(granularity, period)]}, {"$set": values, "$inc": {"rev": 1}}))
+            else:
+                operations.append(InsertOne({**key, **values, "rev": 1}))
+        # Buckets that no longer have any days behind them
+        operations += [
+            DeleteOne({"user_id": user_id, "granularity": granularity, "period": period, "rev": rev})
+            for (granularity, period), rev in seen.items() if (granularity, period) not in buckets
+        ]
+        try:
+            result = await db.activity_rollups.bulk_write(operations, ordered=False)
+            applied = result.matched_count + result.inserted_count + result.deleted_count
+        except BulkWriteError as e:
+            # A bucket was created since `seen` was read
+            applied = e.details.get("nMatched", 0) + e.details.get("nInserted", 0) + e.details.get("nRemoved", 0)
+        if applied == len(operations):
+            return lifetime
+    logger.warning(f"Activity rollups for user {user_id} kept changing during rebuild; left as last written")
+    return lifetime
+
+async def store_rollup(user_id: str, granularity: str, period: str, date: Optional[str], source, query: dict):
+    """Set one bucket to the sum of the `source` documents matching `query`, guarded by its `rev`.
+
+    The rev is read before the sources, so if another writer lands in between
+    this write misses and the bucket is recomputed from a fresh read.
+    """
+    key = {"user_id": user_id, "granularity": granularity, "period": period}
+    for _ in range(ROLLUP_REBUILD_ATTEMPTS):
+        current = await db.activity_rollups.find_one(key, {"_id": 0, "rev": 1})
+        values = {field: 0 for field in ACTIVITY_FIELDS}
+        async for doc in source.find(query, {"_id": 0, **{field: 1 for field in ACTIVITY_FIELDS}}):
+            for field in ACTIVITY_FIELDS:
+                values[field] += doc.get(field, 0)
+        if current is None:
+            try:
+                await db.activity_rollups.insert_one({**key, "date": date, **values, "rev": 1})
+                return
+            except DuplicateKeyError:
+                continue
+        result = await db.activity_rollups.update_one({**key, "rev": current.get("rev")}, {"$set": values, "$inc": {"rev": 1}})
+        if result.matched_count:
+            return
+    logger.warning(f"Activity rollup {granularity} {period} for user {user_id} kept changing; left as last written")
+
+async def update_activity_rollups(user_id: str, increments: List[list]):
+    """Bring the buckets holding these [day, field, amount] increments in line with daily_activity.
+
+    Weeks and months are recomputed from their days, then years from months
+    and lifetime from years, so only the days' buckets are read. The lifetime
+    document is only ever created by a rebuild, so a user whose rollups
+    predate this layer (or were lost) is rebuilt from daily_activity instead.
+    """
+    if not await db.activity_rollups.find_one({"user_id": user_id, "granularity": "lifetime"}, {"_id": 1}):
+        await rebuild_activity_rollups(user_id)
+        return
+    buckets = {bucket for day, _, _ in increments for bucket in activity_periods(day)}
+
+    def covering(granularity: str, source_granularity: Optional[str] = None):
+        for bucket_granularity, period, start in buckets:
+            if bucket_granularity != granularity:
+                continue
+            query = {"user_id": user_id, "date": {"$gte": start, "$lt": period_end(granularity, start)}}
+            if source_granularity:
+                yield store_rollup(user_id, granularity, period, start, db.activity_rollups,
+                                   {**query, "granularity": source_granularity})
+            else:
+                yield store_rollup(user_id, granularity, period, start, db.daily_activity, query)
+
+    await asyncio.gather(*covering("week"), *covering("month"))
+    await asyncio.gather(*covering("year", "month"))
+    await store_rollup(user_id, "lifetime", "all", None, db.activity_rollups, {"user_id": user_id, "granularity": "year"})
 
 def get_trusted_checklist_completions(previous_checklist, next_checklist) -> int:
     if len(previous_checklist) != len(next_checklist):
@@ -414,24 +785,12 @@ def get_trusted_checklist_completions(previous_checklist, next_checklist) -> int
     return newly_completed
 
 async def get_activity_totals(user_id: str):
-    totals = await db.daily_activity.aggregate([
-        {"$match": {"user_id": user_id}},
-        {"$group": {
-            "_id": None,
-            "tasks_completed": {"$sum": "$tasks_completed"},
-            "focus_time": {"$sum": "$focus_time"},
-            "notes_created": {"$sum": "$notes_created"},
-        }},
-    ]).to_list(1)
-
-    if totals:
-        return totals[0]
-
-    return {
-        "tasks_completed": 0,
-        "focus_time": 0,
-        "notes_created": 0,
-    }
+    totals = await db.activity_rollups.find_one(
+        {"user_id": user_id, "granularity": "lifetime", "period": "all"}, {"_id": 0, **{f: 1 for f in ACTIVITY_FIELDS}}
+    )
+    if totals is None:
+        return await rebuild_activity_rollups(user_id)
+    return {field: totals.get(field, 0) for field in ACTIVITY_FIELDS}
 
 async def get_focus_summary(user_id: str, started_since: Optional[str] = None):
     query = {
@@ -459,6 +818,604 @@ async def get_focus_summary(user_id: str, started_since: Optional[str] = None):
         "total_sessions": 0,
     }
 
+async def allocate_sequence(scope: str, owner_id: str, count: int = 1, seed=None) -> int:
+    """Reserve `count` consecutive values from a per-owner counter; returns the first.
+
+    `seed` is an optional coroutine function giving the starting value when the
+    counter is first created, so collections that predate it carry on after
+    their highest existing value.
+    """
+    key = f"{scope}:{owner_id}"
+    for _ in range(2):
+        counter = await db.sequences.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"value": count}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if counter:
+            return counter["value"] - count
+        start = await seed() if seed else 0
+        try:
+            await db.sequences.insert_one({"_id": key, "owner_id": owner_id, "value": start})
+        except DuplicateKeyError:
+            pass  # Another request created it first
+    raise RuntimeError(f"Could not allocate from sequence {key}")
+
+async def raise_sequence_floor(scope: str, owner_id: str, value: int):
+    """Make sure an existing counter will never hand out anything below `value`."""
+    await db.sequences.update_one({"_id": f"{scope}:{owner_id}"}, {"$max": {"value": value}})
+
+async def next_order_after_max(collection, query: dict, field: str = "order") -> int:
+    highest = await collection.find_one(query, {"_id": 0, field: 1}, sort=[(field, -1)])
+    return (highest.get(field, 0) + 1) if highest else 0
+
+# --- Change tracking ---
+# Every write to a synced collection stamps `sync_seq` from a clock-based
+# sequence, and deletes leave a tombstone carrying the same value, so
+# /api/preload can return what changed after a client's cursor. A per-user
+# counter document keeps a version and timestamp per collection, which the
+# read endpoints turn into ETag / Last-Modified validators.
+
+SYNC_COLLECTIONS = ("tasks", "notes", "budget_sheets", "budget_rows", "habits")
+
+_last_change_seq = 0
+
+def next_change_seq() -> int:
+    """The `sync_seq` value for one request's writes.
+
+    Microseconds since the epoch, strictly increasing within this process, so
+    stamping a write costs no round trip. Stamps from different workers can be
+    out of order by their clock skew, which the preload overlap window covers.
+    """
+    global _last_change_seq
+    _last_change_seq = max(_last_change_seq + 1, time.time_ns() // 1000)
+    return _last_change_seq
+
+async def bump_versions(user_id: str, *collections: str):
+    """Move the ETag versions of `collections`. Call once the write has landed.
+
+    Reads take the version before the documents, so bumping afterwards means
+    a tag can be older than the data it was sent with, but never newer.
+    """
+    now = datetime.now(timezone.utc)
+    await db.sequences.update_one(
+        {"_id": f"changes:{user_id}"},
+        {
+            "$inc": {f"versions.{name}": 1 for name in collections},
+            "$max": {f"versions_at.{name}": now for name in collections},
+            "$setOnInsert": {"owner_id": user_id},
+        },
+        upsert=True,
+    )
+
+async def record_deletions(user_id: str, collection: str, ids: List[str], seq: int):
+    if not ids:
+        return
+    deleted_at = datetime.now(timezone.utc)
+    await db.sync_tombstones.insert_many([
+        {"user_id": user_id, "collection": collection, "id": doc_id, "sync_seq": seq, "deleted_at": deleted_at}
+        for doc_id in ids
+    ], ordered=False)
+
+async def not_modified(request: Request, response: Response, user_id: str, collections: tuple,
+                       valid_from: Optional[datetime] = None) -> Optional[Response]:
+    """Set ETag / Last-Modified for a read and return a 304 if the client's copy is current.
+
+    Validators come from the versions kept on the change counter, so this
+    reads one small document and none of the collections themselves. The
+    query string and Accept header are part of the ETag; `valid_from` covers
+    payloads that also change without a write (e.g. habits at midnight).
+    """
+    counter = await db.sequences.find_one(
+        {"_id": f"changes:{user_id}"}, {"_id": 0, "versions": 1, "versions_at": 1}
+    ) or {}
+    versions = counter.get("versions") or {}
+    # Versions are small per-user counters, so the user has to be part of the tag
+    basis = json.dumps([
+        user_id,
+        [versions.get(name, 0) for name in collections],
+        request.url.query,
+        request.headers.get("accept", ""),
+        valid_from.isoformat() if valid_from else None,
+    ])
+    # Weak, since the same payload may be sent with different encodings
+    etag = f'W/"{hashlib.sha1(basis.encode()).hexdigest()[:27]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+
+    stamps = [stamp for stamp in ((counter.get("versions_at") or {}).get(name) for name in collections) if stamp]
+    if valid_from:
+        stamps.append(valid_from)
+    last_modified = None
+    if stamps:
+        # Motor hands back naive UTC datetimes
+        last_modified = max(
+            stamp if stamp.tzinfo else stamp.replace(tzinfo=timezone.utc) for stamp in stamps
+        ).astimezone(timezone.utc).replace(microsecond=0)
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    response.headers.update(headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        current = "*" in tags or etag.removeprefix("W/") in tags
+    else:
+        # Only trusted when every collection has been stamped at least once
+        current = False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and last_modified and len(stamps) == len(collections) + bool(valid_from):
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                since = None
+            current = since is not None and since.tzinfo is not None and last_modified <= since
+    return Response(status_code=304, headers=headers) if current else None
+
+async def reconcile_user_stats(user_id: str) -> dict:
+    """Rebuild a user's running counters from the source collections."""
+    activity_totals, focus_summary, notes_count = await asyncio.gather(
+        get_activity_totals(user_id),
+        get_focus_summary(user_id),
+        db.notes.count_documents({"user_id": user_id}),
+    )
+    stats = {
+        "user_id": user_id,
+        "tasks_completed_total": activity_totals.get("tasks_completed", 0),
+        "focus_sessions_total": focus_summary.get("total_sessions", 0),
+        "focus_minutes_total": focus_summary.get("total_focus_time", 0),
+        "notes_total": notes_count,
+        "reconciled_at": datetime.now(ZoneInfo("Asia/Kolkata")).isoformat(),
+    }
+    await db.user_stats.update_one({"user_id": user_id}, {"$set": stats}, upsert=True)
+    stats_cache.set(user_id, stats)
+    return dict(stats)
+
+async def get_user_stats(user_id: str) -> dict:
+    cached = stats_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+    stats = await db.user_stats.find_one({"user_id": user_id}, {"_id": 0})
+    if stats is None:
+        return await reconcile_user_stats(user_id)
+    stats_cache.set(user_id, stats)
+    return dict(stats)
+
+async def increment_user_stats(user_id: str, **deltas: int):
+    """Apply deltas to the running counters. Call after the source write has landed."""
+    deltas = {field: value for field, value in deltas.items() if value}
+    if not deltas:
+        return
+    stats = await db.user_stats.find_one_and_update(
+        {"user_id": user_id}, {"$inc": deltas}, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+    if stats is None:
+        # Accounts created before counters existed are seeded from source data,
+        # which already includes the write that triggered this call.
+        await reconcile_user_stats(user_id)
+        return
+    # Write through so this worker's dashboard reads see the new totals at once
+    stats_cache.set(user_id, stats)
+
+class SideEffectQueue:
+    """Applies XP, streak, daily activity and achievement updates off the request path.
+
+    Effects queued for the same user within a batch are merged, so a burst of
+    completions costs one XP write and one achievement check. Failed effects are
+    retried with backoff; only the steps that have not yet succeeded are re-run.
+    With SIDE_EFFECT_OUTBOX enabled every effect is also persisted before it is
+    queued. Workers keep the rows they hold fresh, and periodically pick up
+    rows left stale by a worker that went away.
+    """
+
+    def __init__(self, batch_size: int, max_attempts: int, use_outbox: bool):
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max(1, max_attempts)
+        self.use_outbox = use_outbox
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._retries: dict = {}
+        self._pending_checks: set = set()
+        self._held: set = set()  # Outbox ids queued, running or waiting to retry here
+        self._recovery: Optional[asyncio.Task] = None
+        self._draining = False
+
+    @staticmethod
+    def _new_effect(user_id: str) -> dict:
+        return {"user_id": user_id, "xp": 0, "activity": {}, "rollups": [], "stats": {}, "streak": False, "achievements": False, "versions": []}
+
+    async def enqueue(self, user_id: str, xp: int = 0, activity: Optional[dict] = None, stats: Optional[dict] = None,
+                      streak: bool = False, achievements: bool = False):
+        effect = self._new_effect(user_id)
+        effect.update(xp=xp, activity=dict(activity or {}), stats=dict(stats or {}), streak=streak, achievements=achievements)
+        item = {"effect": effect, "attempts": 0, "outbox_ids": []}
+        if self.use_outbox:
+            outbox_id = str(uuid.uuid4())
+            await db.side_effect_outbox.insert_one({
+                "id": outbox_id,
+                "user_id": user_id,
+                "effect": effect,
+                "status": "pending",
+                "attempts": 0,
+                "updated_at": datetime.now(timezone.utc),
+            })
+            item["outbox_ids"].append(outbox_id)
+            self._held.add(outbox_id)
+        self._queue.put_nowait(item)
+
+    def queue_achievement_check(self, user_id: str):
+        """Queue a catch-up achievement check from a read path.
+
+        Kept in memory only (it's recomputed from counters if lost) and queued
+        at most once per user until it has run, so repeated GETs add nothing.
+        """
+        if user_id in self._pending_checks:
+            return
+        self._pending_checks.add(user_id)
+        effect = self._new_effect(user_id)
+        effect["achievements"] = True
+        self._queue.put_nowait({"effect": effect, "attempts": 0, "outbox_ids": []})
+
+    def queue_version_bump(self, user_id: str, *collections: str):
+        """Move the ETag versions of `collections` once the caller's write has landed.
+
+        The worker merges these per user, so a burst of writes costs one
+        counter update and none of it is on the request path. In memory only:
+        a bump lost with the process leaves the old tag valid until the next
+        write to that collection.
+        """
+        effect = self._new_effect(user_id)
+        effect["versions"] = list(collections)
+        self._queue.put_nowait({"effect": effect, "attempts": 0, "outbox_ids": []})
+
+    def start(self):
+        self._draining = False
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        if self.use_outbox and (self._recovery is None or self._recovery.done()):
+            self._recovery = asyncio.create_task(self._recover_periodically())
+
+    async def _recover_periodically(self):
+        """Heartbeat the outbox rows held here, then take over rows other workers left stale."""
+        interval = max(1.0, SIDE_EFFECT_OUTBOX_STALE_SECONDS / 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if self._held:
+                    await db.side_effect_outbox.update_many(
+                        {"id": {"$in": list(self._held)}, "status": "pending"},
+                        {"$set": {"updated_at": datetime.now(timezone.utc)}},
+                    )
+                await self.recover()
+            except Exception as e:
+                logger.error(f"Side effect outbox recovery failed: {e}")
+
+    async def recover(self, limit: int = 1000):
+        """Re-queue outbox entries left pending by a worker that went away."""
+        if not self.use_outbox:
+            return 0
+        recovered = 0
+        while recovered < limit:
+            stale_before = datetime.now(timezone.utc) - timedelta(seconds=SIDE_EFFECT_OUTBOX_STALE_SECONDS)
+            entry = await db.side_effect_outbox.find_one_and_update(
+                {"status": "pending", "updated_at": {"$lt": stale_before}},
+                {"$set": {"updated_at": datetime.now(timezone.utc)}},
+                projection={"_id": 0},
+            )
+            if not entry:
+                break
+            self._queue.put_nowait({"effect": entry["effect"], "attempts": entry.get("attempts", 0), "outbox_ids": [entry["id"]]})
+            self._held.add(entry["id"])
+            recovered += 1
+        if recovered:
+            logger.info(f"Recovered {recovered} pending side effects from outbox")
+        return recovered
+
+    async def drain(self, timeout: float):
+        """Flush queued and retrying effects, then stop the worker.
+
+        Effects that fail while draining are not retried here; their outbox
+        rows stay pending for another worker to recover.
+        """
+        self._draining = True
+        if self._recovery is not None:
+            self._recovery.cancel()
+        for task, item in list(self._retries.items()):
+            task.cancel()
+            self._queue.put_nowait(item)
+        self._retries.clear()
+        if self._worker is not None and not self._worker.done():
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Side effect queue not drained; {self._queue.qsize()} batches left pending")
+            self._worker.cancel()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._process(batch)
+            except Exception as e:
+                logger.error(f"Side effect batch failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _process(self, batch: list):
+        merged: dict = {}
+        for item in batch:
+            effect = item["effect"]
+            target = merged.setdefault(effect["user_id"], {"effect": self._new_effect(effect["user_id"]), "attempts": 0, "outbox_ids": []})
+            combined = target["effect"]
+            combined["xp"] += effect.get("xp", 0)
+            for field, value in effect.get("activity", {}).items():
+                combined["activity"][field] = combined["activity"].get(field, 0) + value
+            combined["rollups"].extend(effect.get("rollups", []))
+            for field, value in effect.get("stats", {}).items():
+                combined["stats"][field] = combined["stats"].get(field, 0) + value
+            combined["streak"] = combined["streak"] or effect.get("streak", False)
+            combined["achievements"] = combined["achievements"] or effect.get("achievements", False)
+            for name in self._versions_of(effect):
+                if name not in combined["versions"]:
+                    combined["versions"].append(name)
+            target["attempts"] = max(target["attempts"], item["attempts"])
+            target["outbox_ids"].extend(item["outbox_ids"])
+
+        for item in merged.values():
+            # One user's failure must not hold up the rest of the batch
+            user_id = item["effect"]["user_id"]
+            checks_achievements = item["effect"]["achievements"]
+            try:
+                try:
+                    await self._apply(item["effect"])
+                except Exception as e:
+                    await self._retry(item, e)
+                    continue
+                if checks_achievements:
+                    self._pending_checks.discard(user_id)
+                if item["outbox_ids"]:
+                    await db.side_effect_outbox.delete_many({"id": {"$in": item["outbox_ids"]}})
+                    self._held.difference_update(item["outbox_ids"])
+            except Exception as e:
+                # Anything still in the outbox is recovered once it goes stale
+                logger.error(f"Side effects for user {user_id} could not be settled: {e}")
+
+    @staticmethod
+    def _versions_of(effect: dict) -> list:
+        versions = effect.get("versions") or []
+        # Outbox entries written before versions named their collections
+        return ["achievements"] if versions is True else versions
+
+    @classmethod
+    async def _apply(cls, effect: dict):
+        """Run each step once, clearing it so a retry only repeats what failed."""
+        user_id = effect["user_id"]
+        effect["versions"] = cls._versions_of(effect)
+        if (effect["stats"] or effect["streak"] or effect["achievements"]) and "achievements" not in effect["versions"]:
+            # GET /api/achievements reads all three, so its version moves once they land
+            effect["versions"].append("achievements")
+        if effect["xp"]:
+            await add_xp(user_id, effect["xp"])
+            effect["xp"] = 0
+        for field in list(effect["activity"]):
+            day = await update_daily_activity(user_id, field, effect["activity"][field])
+            # Rollups follow as their own step, pinned to the day just written
+            effect.setdefault("rollups", []).append([day, field, effect["activity"].pop(field)])
+        if effect.get("rollups"):
+            await update_activity_rollups(user_id, effect["rollups"])
+            effect["rollups"] = []
+        if effect["stats"]:
+            await increment_user_stats(user_id, **effect["stats"])
+            effect["stats"] = {}
+        if effect["streak"]:
+            await update_streak(user_id)
+            effect["streak"] = False
+        if effect["achievements"]:
+            await check_achievements(user_id)
+            effect["achievements"] = False
+        if effect["versions"]:
+            await bump_versions(user_id, *effect["versions"])
+            effect["versions"] = []
+
+    async def _retry(self, item: dict, error: Exception):
+        item["attempts"] += 1
+        user_id = item["effect"]["user_id"]
+        if item["attempts"] >= self.max_attempts:
+            logger.error(f"Dropping side effects for user {user_id} after {item['attempts']} attempts: {error}")
+            self._pending_checks.discard(user_id)
+            self._held.difference_update(item["outbox_ids"])
+            if item["outbox_ids"]:
+                await self._store_outbox(item, "failed", effect=item["effect"], error=str(error))
+            return
+        if self._draining:
+            # No backoff left to wait out; the outbox row (if any) stays pending
+            logger.warning(f"Side effects for user {user_id} failed while draining, left pending: {error}")
+            self._pending_checks.discard(user_id)
+            self._held.difference_update(item["outbox_ids"])
+        else:
+            logger.warning(f"Side effects for user {user_id} failed (attempt {item['attempts']}), retrying: {error}")
+            task = asyncio.create_task(self._requeue_later(item, min(30.0, 0.5 * 2 ** item["attempts"])))
+            self._retries[task] = item
+        if item["outbox_ids"]:
+            await self._store_outbox(
+                item, "pending", effect=item["effect"], attempts=item["attempts"], updated_at=datetime.now(timezone.utc)
+            )
+
+    async def _store_outbox(self, item: dict, status: str, **fields):
+        """Persist a merged effect on the first of its outbox rows and retire the others.
+
+        Every row of a merged batch would otherwise carry the whole effect, and
+        recover() would replay it once per row. The rest are marked "merged" in
+        the same command, so no crash can leave the effect stored twice.
+        """
+        keep = item["outbox_ids"][0]
+        await db.side_effect_outbox.update_many(
+            {"id": {"$in": item["outbox_ids"]}},
+            [{"$set": {**literal_set(fields), "status": {"$cond": [{"$eq": ["$id", keep]}, status, "merged"]}}}],
+        )
+        if len(item["outbox_ids"]) > 1:
+            await db.side_effect_outbox.delete_many({"id": {"$in": item["outbox_ids"][1:]}, "status": "merged"})
+            self._held.difference_update(item["outbox_ids"][1:])
+            item["outbox_ids"] = [keep]
+
+    async def _requeue_later(self, item: dict, delay: float):
+        await asyncio.sleep(delay)
+        self._retries.pop(asyncio.current_task(), None)
+        self._queue.put_nowait(item)
+
+side_effects = SideEffectQueue(SIDE_EFFECT_BATCH_SIZE, SIDE_EFFECT_MAX_ATTEMPTS, SIDE_EFFECT_OUTBOX)
+
+def encode_cursor(values: dict) -> str:
+    """Pack keyset values into an opaque, URL-safe cursor."""
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, dict):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def keyset_query(query: dict, sort_field: str, direction: int, cursor: Optional[str]) -> dict:
+    """Restrict `query` to documents after the cursor position in (sort_field, id) order."""
+    if not cursor:
+        return query
+    values = decode_cursor(cursor)
+    if sort_field not in values or "id" not in values:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    op = "$lt" if direction < 0 else "$gt"
+    position = values[sort_field]
+    return {"$and": [query, {"$or": [
+        {sort_field: {op: position}},
+        {sort_field: position, "id": {op: values["id"]}},
+    ]}]}
+
+async def fetch_page(collection, query: dict, projection: dict, sort_field: str, direction: int,
+                     limit: int, cursor: Optional[str], response: Response) -> list:
+    """Fetch one keyset page; sets X-Next-Cursor when more documents follow."""
+    docs = await collection.find(
+        keyset_query(query, sort_field, direction, cursor), projection
+    ).sort([(sort_field, direction), ("id", direction)]).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor({sort_field: last.get(sort_field), "id": last["id"]})
+    return docs
+
+def dump_json(value) -> str:
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(value, default=str)
+
+_model_shapes: dict = {}
+
+def _model_shape(model) -> tuple:
+    """(name, required, default) for each field of a response model, built once per model."""
+    shape = _model_shapes.get(model)
+    if shape is None:
+        shape = _model_shapes[model] = tuple(
+            (name, field.is_required(), None if field.is_required() else field.get_default(call_default_factory=True))
+            for name, field in model.model_fields.items()
+        )
+    return shape
+
+def send_documents(content, response: Response, model=None):
+    """Return documents written by this app, skipping the response_model pass when configured.
+
+    With RESPONSE_MODEL_VALIDATION on this is a no-op and FastAPI validates as
+    usual. Off, list content is trimmed to `model`'s fields (filling defaults
+    the way validation would) and serialized straight away, keeping any
+    headers already set on `response`.
+    """
+    if RESPONSE_MODEL_VALIDATION:
+        return content
+    if model is not None:
+        shape = _model_shape(model)
+        content = [
+            {name: doc[name] if name in doc else default for name, required, default in shape if name in doc or not required}
+            for doc in content
+        ]
+    if orjson is None:
+        content = jsonable_encoder(content)
+    return FastJSONResponse(content, headers=dict(response.headers))
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def stream_ndjson(collection, query: dict, projection: dict, sort_field: str, direction: int,
+                  limit: Optional[int], cursor: Optional[str], transform=None) -> StreamingResponse:
+    """Stream matching documents as newline-delimited JSON straight off the Mongo cursor.
+
+    Documents are sent as stored (no response_model pass), and memory stays
+    bounded by one cursor batch regardless of result size.
+    """
+    mongo_cursor = collection.find(
+        keyset_query(query, sort_field, direction, cursor), projection
+    ).sort([(sort_field, direction), ("id", direction)]).batch_size(NDJSON_FLUSH_DOCS)
+    if limit:
+        mongo_cursor = mongo_cursor.limit(limit)
+
+    async def generate():
+        lines = []
+        async for doc in mongo_cursor:
+            if transform:
+                doc = transform(doc)
+            lines.append(dump_json(doc))
+            if len(lines) >= NDJSON_FLUSH_DOCS:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    return StreamingResponse(generate(), media_type=NDJSON_MEDIA_TYPE)
+
+def literal_set(fields: dict) -> dict:
+    """Wrap values for a pipeline-style $set so strings like "$5 lunch" aren't read as field paths."""
+    return {field: {"$literal": value} for field, value in fields.items()}
+
+def normalize_note(note: dict) -> dict:
+    """Handle legacy notes that stored a single `category` instead of `categories`."""
+    if "categories" not in note:
+        note["categories"] = [note.pop("category", "general")] if isinstance(note.get("category"), str) else note.get("category", ["general"])
+    note.pop("content_text", None)  # Search-only copy of the content
+    return note
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
+def html_to_text(text: Optional[str]) -> str:
+    """Editor HTML as plain text, whitespace collapsed."""
+    return " ".join(html.unescape(_TAG_RE.sub(" ", text or "")).split())
+
+async def bulk_reorder(collection, owner_filter: dict, field: str, ids: List[str], moves: List[ReorderMove],
+                       stamp: Optional[dict] = None) -> dict:
+    """Apply a full id ordering or a sparse list of moves as one unordered bulk_write.
+
+    Every update is scoped by `owner_filter`, so ids the caller doesn't own are
+    silently skipped. `stamp` adds extra fields (e.g. sync_seq) to every
+    update. Returns match counts and the highest order written.
+    """
+    if ids and moves:
+        raise HTTPException(status_code=400, detail="Send either a full id list or moves, not both")
+    if len(ids) > MAX_PAGE_SIZE or len(moves) > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_PAGE_SIZE} items can be reordered at once")
+    positions = [(doc_id, index) for index, doc_id in enumerate(ids)] or [(move.id, move.order) for move in moves]
+    if not positions:
+        return {"matched": 0, "modified": 0, "max_order": None}
+    result = await collection.bulk_write(
+        [UpdateOne({**owner_filter, "id": doc_id}, {"$set": {field: order, **(stamp or {})}}) for doc_id, order in positions],
+        ordered=False,
+    )
+    return {
+        "matched": result.matched_count,
+        "modified": result.modified_count,
+        "max_order": max(order for _, order in positions),
+    }
+
 ALLOWED_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg', '.bmp', '.ico'}
 MAX_UPLOAD_SIZE = 5 * 1024 * 1024  # 5MB
 
@@ -595,7 +1552,7 @@ async def register(request: Request, data: UserCreate):
         "id": user_id,
         "email": email,
         "username": data.username,
-        "password_hash": hash_password(data.password),
+        "password_hash": await hash_password(data.password),
         "current_level": 1,
         "total_xp": 0,
         "current_streak": 0,
@@ -626,7 +1583,7 @@ async def register(request: Request, data: UserCreate):
 async def login(request: Request, data: UserLogin):
     email = data.email.lower()
     user = await db.users.find_one({"email": email}, {"_id": 0})
-    if not user or not verify_password(data.password, user["password_hash"]):
+    if not user or not await verify_password(data.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     token = create_token(user["id"], user["email"])
@@ -677,6 +1634,8 @@ async def refresh_token(request: Request, user: dict = Depends(get_current_user)
 async def delete_user_account(user: dict = Depends(get_current_user)):
     """Delete user account and all associated data (cascading delete)."""
     user_id = user["id"]
+    user_cache.invalidate(user_id)
+    stats_cache.invalidate(user_id)
 
     # Delete all user data from all collections in parallel for speed
     await asyncio.gather(
@@ -687,33 +1646,47 @@ async def delete_user_account(user: dict = Depends(get_current_user)):
         db.focus_sessions.delete_many({"user_id": user_id}),
         db.habits.delete_many({"user_id": user_id}),
         db.daily_activity.delete_many({"user_id": user_id}),
+        db.activity_rollups.delete_many({"user_id": user_id}),
         db.user_achievements.delete_many({"user_id": user_id}),
+        db.user_stats.delete_many({"user_id": user_id}),
+        db.sequences.delete_many({"owner_id": user_id}),
+        db.sync_tombstones.delete_many({"user_id": user_id}),
     )
 
     # Finally delete the user (must happen after data is cleaned)
     await db.users.delete_one({"id": user_id})
+    user_cache.invalidate(user_id)
+    stats_cache.invalidate(user_id)
 
     return {"message": "Account and all data deleted successfully"}
 
 # ============ TASK ROUTES ============
 
 @api_router.get("/tasks", response_model=List[TaskResponse])
-async def get_tasks(status: Optional[str] = None, user: dict = Depends(get_current_user)):
+async def get_tasks(
+    request: Request,
+    response: Response,
+    status: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+):
+    unchanged = await not_modified(request, response, user["id"], ("tasks",))
+    if unchanged:
+        return unchanged
     query = {"user_id": user["id"]}
     if status:
         query["status"] = status
     
-    tasks = await db.tasks.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
-    return tasks
+    if wants_ndjson(request):
+        return stream_ndjson(db.tasks, query, {"_id": 0}, "created_at", -1, limit, cursor)
+    tasks = await fetch_page(db.tasks, query, {"_id": 0}, "created_at", -1, limit or 1000, cursor, response)
+    return send_documents(tasks, response, TaskResponse)
 
-@api_router.post("/tasks", response_model=TaskResponse)
-async def create_task(data: TaskCreate, user: dict = Depends(get_current_user)):
-    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-    task_id = str(uuid.uuid4())
-    
-    task_doc = {
-        "id": task_id,
-        "user_id": user["id"],
+def build_task_doc(user_id: str, data: TaskCreate, now: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
         "title": data.title,
         "description": data.description or "",
         "priority": data.priority,
@@ -729,12 +1702,29 @@ async def create_task(data: TaskCreate, user: dict = Depends(get_current_user)):
         "created_at": now,
         "updated_at": now
     }
+
+@api_router.post("/tasks", response_model=TaskResponse)
+async def create_task(data: TaskCreate, user: dict = Depends(get_current_user)):
+    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
+    task_doc = build_task_doc(user["id"], data, now)
+    task_doc["sync_seq"] = next_change_seq()
     
     await db.tasks.insert_one(task_doc)
-    await add_xp(user["id"], 5)  # XP for creating a task
+    side_effects.queue_version_bump(user["id"], "tasks")
+    await side_effects.enqueue(user["id"], xp=5)  # XP for creating a task
     
     return TaskResponse(**task_doc)
 
+@api_router.put("/tasks/reorder")
+async def reorder_tasks(data: TaskReorder, user: dict = Depends(get_current_user)):
+    """Set task positions from a full id list or sparse moves in one bulk_write."""
+    result = await bulk_reorder(
+        db.tasks, {"user_id": user["id"]}, "position", data.task_ids, data.moves,
+        stamp={"sync_seq": next_change_seq()},
+    )
+    side_effects.queue_version_bump(user["id"], "tasks")
+    return {"message": "Tasks reordered", "matched": result["matched"], "modified": result["modified"]}
+
 @api_router.get("/tasks/{task_id}", response_model=TaskResponse)
 async def get_task(task_id: str, user: dict = Depends(get_current_user)):
     task = await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, {"_id": 0})
@@ -744,16 +1734,44 @@ async def get_task(task_id: str, user: dict = Depends(get_current_user)):
 
 @api_router.put("/tasks/{task_id}", response_model=TaskResponse)
 async def update_task(task_id: str, data: TaskUpdate, user: dict = Depends(get_current_user)):
-    task = await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, {"_id": 0})
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
+    owner = {"id": task_id, "user_id": user["id"]}
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
     update_data["updated_at"] = now
+    update_data["sync_seq"] = next_change_seq()
+
+    if "status" not in update_data and "checklist" not in update_data:
+        updated_task = await db.tasks.find_one_and_update(
+            owner, {"$set": update_data}, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+        if not updated_task:
+            raise HTTPException(status_code=404, detail="Task not found")
+        side_effects.queue_version_bump(user["id"], "tasks")
+        return updated_task
+
+    # Status and checklist changes depend on the stored values, so apply the
+    # update and read the pre-image in one round trip. completed_at is decided
+    # from the stored status inside the update, so two concurrent completions
+    # can't both be treated as the transition.
+    fields = literal_set(update_data)
+    if "status" in update_data:
+        was_completed = {"$eq": ["$status", "completed"]}
+        if update_data["status"] == "completed":
+            fields["completed_at"] = {"$cond": [was_completed, "$completed_at", {"$literal": now}]}
+        else:
+            fields["completed_at"] = {"$cond": [was_completed, None, "$completed_at"]}
+    task = await db.tasks.find_one_and_update(
+        owner, [{"$set": fields}], projection={"_id": 0}, return_document=ReturnDocument.BEFORE
+    )
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    side_effects.queue_version_bump(user["id"], "tasks")
     
     old_status = task.get("status", "pending")
     new_status = update_data.get("status", old_status)
+    updated_task = {**task, **update_data}
+    tasks_completed = 0
+    xp_reward = 0
     
     # Handle checklist item completions
     if "checklist" in update_data:
@@ -763,59 +1781,62 @@ async def update_task(task_id: str, data: TaskUpdate, user: dict = Depends(get_c
         )
         
         if newly_completed > 0:
-            xp_reward = (10 + (task.get("priority", 1) * 10)) * newly_completed
-            await add_xp(user["id"], xp_reward)
-            await update_daily_activity(user["id"], "tasks_completed", newly_completed)
-            await update_streak(user["id"])
-            await check_achievements(user["id"])
+            tasks_completed += newly_completed
+            xp_reward += (10 + (task.get("priority", 1) * 10)) * newly_completed
 
     # Handle status transition: non-completed -> completed
     if new_status == "completed" and old_status != "completed":
-        update_data["completed_at"] = now
-        await db.tasks.update_one({"id": task_id}, {"$set": update_data})
+        updated_task["completed_at"] = now
         
         # Trigger gamification side effects (only if the card itself was marked completed)
-        xp_reward = 10 + (task.get("priority", 1) * 10)
-        await add_xp(user["id"], xp_reward)
-        await update_streak(user["id"])
-        await update_daily_activity(user["id"], "tasks_completed")
+        tasks_completed += 1
+        xp_reward += 10 + (task.get("priority", 1) * 10)
     # Handle status transition: completed -> non-completed (undo)
     elif old_status == "completed" and new_status != "completed":
-        update_data["completed_at"] = None
-        await db.tasks.update_one({"id": task_id}, {"$set": update_data})
-    else:
-        await db.tasks.update_one({"id": task_id}, {"$set": update_data})
+        updated_task["completed_at"] = None
+
+    if tasks_completed:
+        await side_effects.enqueue(
+            user["id"],
+            xp=xp_reward,
+            activity={"tasks_completed": tasks_completed},
+            stats={"tasks_completed_total": tasks_completed},
+            streak=True,
+            achievements=True,
+        )
     
-    updated_task = await db.tasks.find_one({"id": task_id}, {"_id": 0})
     return updated_task
 
 @api_router.patch("/tasks/{task_id}/complete", response_model=TaskResponse)
 async def complete_task(task_id: str, user: dict = Depends(get_current_user)):
-    task = await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, {"_id": 0})
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-
-    if task.get("status") == "completed":
-        return task
-    
     now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
     
-    await db.tasks.update_one(
-        {"id": task_id},
-        {"$set": {"status": "completed", "completed_at": now, "updated_at": now}}
+    task = await db.tasks.find_one_and_update(
+        {"id": task_id, "user_id": user["id"], "status": {"$ne": "completed"}},
+        {"$set": {"status": "completed", "completed_at": now, "updated_at": now,
+                  "sync_seq": next_change_seq()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
     )
+    if not task:
+        # Either missing or already completed; only the latter needs a read
+        task = await db.tasks.find_one({"id": task_id, "user_id": user["id"]}, {"_id": 0})
+        if not task:
+            raise HTTPException(status_code=404, detail="Task not found")
+        return task
+    side_effects.queue_version_bump(user["id"], "tasks")
     
-    # Award XP based on priority
-    xp_reward = 10 + (task.get("priority", 1) * 10)
-    await add_xp(user["id"], xp_reward)
-    
-    # Update streak and daily activity
-    await update_streak(user["id"])
-    await update_daily_activity(user["id"], "tasks_completed")
-    await check_achievements(user["id"])
+    # Award XP based on priority, then update daily activity, streak and achievements
+    await side_effects.enqueue(
+        user["id"],
+        xp=10 + (task.get("priority", 1) * 10),
+        activity={"tasks_completed": 1},
+        stats={"tasks_completed_total": 1},
+        streak=True,
+        achievements=True,
+    )
     
-    updated_task = await db.tasks.find_one({"id": task_id}, {"_id": 0})
-    return updated_task
+    return task
 
 
 @api_router.delete("/tasks/{task_id}")
@@ -823,84 +1844,371 @@ async def delete_task(task_id: str, user: dict = Depends(get_current_user)):
     result = await db.tasks.delete_one({"id": task_id, "user_id": user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Task not found")
+    await record_deletions(user["id"], "tasks", [task_id], next_change_seq())
+    side_effects.queue_version_bump(user["id"], "tasks")
     return {"message": "Task deleted"}
 
 # ============ NOTE ROUTES ============
 
 @api_router.get("/notes", response_model=List[NoteResponse])
-async def get_notes(category: Optional[str] = None, user: dict = Depends(get_current_user)):
+async def get_notes(
+    request: Request,
+    response: Response,
+    category: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+):
     query = {"user_id": user["id"]}
     if category:
         # Query the 'categories' array field (MongoDB matches array elements automatically)
         query["categories"] = category
     
-    notes = await db.notes.find(query, {"_id": 0}).sort("updated_at", -1).to_list(1000)
+    if wants_ndjson(request):
+        return stream_ndjson(db.notes, query, {"_id": 0}, "updated_at", -1, limit, cursor, normalize_note)
+    notes = await fetch_page(db.notes, query, {"_id": 0}, "updated_at", -1, limit or 1000, cursor, response)
     # Handle legacy data and field rename
-    for n in notes:
-        if "categories" not in n:
-            n["categories"] = [n.pop("category", "general")] if isinstance(n.get("category"), str) else n.get("category", ["general"])
-    return notes
+    return send_documents([normalize_note(n) for n in notes], response, NoteResponse)
 
 @api_router.get("/notes/index", response_model=List[NoteSummaryResponse])
-async def get_note_index(category: Optional[str] = None, user: dict = Depends(get_current_user)):
+async def get_note_index(
+    request: Request,
+    response: Response,
+    category: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+):
+    unchanged = await not_modified(request, response, user["id"], ("notes",))
+    if unchanged:
+        return unchanged
     query = {"user_id": user["id"]}
     if category:
         query["categories"] = category
 
-    notes = await db.notes.find(query, {"_id": 0, "content": 0}).sort("updated_at", -1).to_list(1000)
-    for n in notes:
-        if "categories" not in n:
-            n["categories"] = [n.pop("category", "general")] if isinstance(n.get("category"), str) else n.get("category", ["general"])
-    return notes
+    projection = {"_id": 0, "content": 0, "content_text": 0}
+    if wants_ndjson(request):
+        return stream_ndjson(db.notes, query, projection, "updated_at", -1, limit, cursor, normalize_note)
+    notes = await fetch_page(db.notes, query, projection, "updated_at", -1, limit or 1000, cursor, response)
+    return send_documents([normalize_note(n) for n in notes], response, NoteSummaryResponse)
 
-@api_router.post("/notes", response_model=NoteResponse)
-async def create_note(data: NoteCreate, user: dict = Depends(get_current_user)):
-    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-    note_id = str(uuid.uuid4())
-    
-    note_doc = {
-        "id": note_id,
-        "user_id": user["id"],
+def build_note_doc(user_id: str, data: NoteCreate, now: str, ancestors: List[str]) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
         "title": data.title,
         "content": data.content,
+        "content_text": html_to_text(data.content),
         "categories": data.categories,
         "is_favorite": data.is_favorite,
         "parent_id": data.parent_id,
+        "ancestors": ancestors,
         "tags": [],
+        "revision": 0,
         "created_at": now,
         "updated_at": now
     }
+
+@api_router.post("/notes", response_model=NoteResponse)
+async def create_note(data: NoteCreate, user: dict = Depends(get_current_user)):
+    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
+    ancestors = await note_path_below(user["id"], data.parent_id)
+    if ancestors is None:
+        raise HTTPException(status_code=404, detail="Parent note not found")
+    note_doc = build_note_doc(user["id"], data, now, ancestors)
+    note_doc["sync_seq"] = next_change_seq()
     
     await db.notes.insert_one(note_doc)
-    await add_xp(user["id"], 5)
-    await update_daily_activity(user["id"], "notes_created")
+    side_effects.queue_version_bump(user["id"], "notes")
+    await side_effects.enqueue(
+        user["id"],
+        xp=5,
+        activity={"notes_created": 1},
+        stats={"notes_total": 1},
+        achievements=True,
+    )
     
     return NoteResponse(**note_doc)
 
+# --- Note tree ---
+# Each note stores `ancestors`, the ids from its root down to its parent, so
+# a subtree is one indexed query on `ancestors` and moving or deleting a
+# subtree is a single update_many/delete_many. Notes created before the field
+# existed are backfilled per user the first time the tree is used.
+
+NOTE_TREE_PROJECTION = {"_id": 0, "content": 0, "content_text": 0}
+
+async def ensure_note_ancestors(user_id: str):
+    """Backfill `ancestors` for a user's notes from their parent_id links.
+
+    The new paths are a change clients must see, so they're stamped with a
+    sync_seq and move the notes version like any other note write.
+    """
+    if not await db.notes.find_one({"user_id": user_id, "ancestors": {"$exists": False}}, {"_id": 1}):
+        return
+    parents, missing = {}, []
+    async for note in db.notes.find({"user_id": user_id}, {"_id": 0, "id": 1, "parent_id": 1, "ancestors": 1}):
+        parents[note["id"]] = note.get("parent_id")
+        if "ancestors" not in note:
+            missing.append(note["id"])
+    seq = next_change_seq()
+    operations = []
+    for note_id in missing:
+        path, seen = [], {note_id}
+        parent_id = parents[note_id]
+        # Stop at roots, dangling parents and (corrupt) cycles
+        while parent_id in parents and parent_id not in seen:
+            path.append(parent_id)
+            seen.add(parent_id)
+            parent_id = parents[parent_id]
+        operations.append(UpdateOne(
+            {"id": note_id, "user_id": user_id, "ancestors": {"$exists": False}},
+            {"$set": {"ancestors": path[::-1], "sync_seq": seq}},
+        ))
+    if operations:
+        await db.notes.bulk_write(operations, ordered=False)
+        side_effects.queue_version_bump(user_id, "notes")
+
+NOTE_TEXT_BACKFILL_BATCH = 200
+
+async def ensure_note_text(user_id: str):
+    """Backfill the plain-text `content_text` that the search index covers.
+
+    Works through the notes a batch at a time, so only one batch of content
+    is held in memory however many notes are missing it.
+    """
+    if not await db.notes.find_one({"user_id": user_id, "content_text": {"$exists": False}}, {"_id": 1}):
+        return
+    missing = db.notes.find(
+        {"user_id": user_id, "content_text": {"$exists": False}}, {"content": 1}
+    ).batch_size(NOTE_TEXT_BACKFILL_BATCH)
+    operations = []
+    async for note in missing:
+        operations.append(UpdateOne(
+            {"_id": note["_id"], "content_text": {"$exists": False}},
+            {"$set": {"content_text": html_to_text(note.get("content"))}},
+        ))
+        if len(operations) >= NOTE_TEXT_BACKFILL_BATCH:
+            await db.notes.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.notes.bulk_write(operations, ordered=False)
+
+async def note_path_below(user_id: str, parent_id: Optional[str]) -> Optional[List[str]]:
+    """The `ancestors` value for a note placed under `parent_id`; None if the parent doesn't exist."""
+    if parent_id is None:
+        return []
+    parent = await db.notes.find_one({"id": parent_id, "user_id": user_id}, {"_id": 0, "ancestors": 1})
+    if parent and "ancestors" not in parent:
+        await ensure_note_ancestors(user_id)
+        parent = await db.notes.find_one({"id": parent_id, "user_id": user_id}, {"_id": 0, "ancestors": 1})
+    if not parent:
+        return None
+    return parent["ancestors"] + [parent_id]
+
+async def plan_note_move(user_id: str, note_id: str, parent_id: Optional[str]) -> tuple:
+    """Validate a move without writing; returns (old depth, new ancestors) for move_descendants."""
+    await ensure_note_ancestors(user_id)
+    note = await db.notes.find_one({"id": note_id, "user_id": user_id}, {"_id": 0, "ancestors": 1})
+    if not note:
+        raise HTTPException(status_code=404, detail="Note not found")
+    if parent_id == note_id:
+        raise HTTPException(status_code=400, detail="A note can't be its own parent")
+    new_path = await note_path_below(user_id, parent_id)
+    if new_path is None:
+        raise HTTPException(status_code=404, detail="Parent note not found")
+    if note_id in new_path:
+        raise HTTPException(status_code=400, detail="Can't move a note under its own descendant")
+    return len(note["ancestors"]), new_path
+
+async def move_note(user_id: str, note_id: str, parent_id: Optional[str], seq: int):
+    """Re-parent a note, rewriting the ancestors of its whole subtree in one update_many."""
+    depth, new_path = await plan_note_move(user_id, note_id, parent_id)
+    await db.notes.update_one(
+        {"id": note_id, "user_id": user_id},
+        {"$set": {"parent_id": parent_id, "ancestors": new_path, "sync_seq": seq}},
+    )
+    await move_descendants(user_id, note_id, depth, new_path, seq)
+
+async def move_descendants(user_id: str, note_id: str, depth: int, new_path: List[str], seq: int):
+    """Swap the old ancestor prefix of a moved note's descendants for its new path."""
+    # Descendants keep everything below the old prefix and get the new one
+    await db.notes.update_many(
+        {"user_id": user_id, "ancestors": note_id},
+        [{"$set": {
+            "ancestors": {"$concatArrays": [
+                {"$literal": new_path},
+                {"$slice": ["$ancestors", depth, {"$size": "$ancestors"}]},
+            ]},
+            "sync_seq": {"$literal": seq},
+        }}],
+    )
+
+@api_router.get("/notes/children", response_model=List[NoteSummaryResponse])
+async def get_note_children(
+    request: Request,
+    response: Response,
+    parent_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+):
+    """Direct children of `parent_id`, or the top-level notes when it's omitted, oldest first."""
+    query = {"user_id": user["id"], "parent_id": parent_id}
+    if wants_ndjson(request):
+        return stream_ndjson(db.notes, query, NOTE_TREE_PROJECTION, "created_at", 1, limit, cursor, normalize_note)
+    notes = await fetch_page(db.notes, query, NOTE_TREE_PROJECTION, "created_at", 1, limit or 1000, cursor, response)
+    return send_documents([normalize_note(n) for n in notes], response, NoteSummaryResponse)
+
+@api_router.get("/notes/{note_id}/subtree", response_model=List[NoteSummaryResponse])
+async def get_note_subtree(note_id: str, user: dict = Depends(get_current_user)):
+    """A note and all of its descendants, shallowest first."""
+    await ensure_note_ancestors(user["id"])
+    notes = await db.notes.find(
+        {"user_id": user["id"], "$or": [{"id": note_id}, {"ancestors": note_id}]}, NOTE_TREE_PROJECTION
+    ).to_list(None)
+    if not any(n["id"] == note_id for n in notes):
+        raise HTTPException(status_code=404, detail="Note not found")
+    notes.sort(key=lambda n: (len(n.get("ancestors", [])), n.get("created_at", ""), n["id"]))
+    return [normalize_note(n) for n in notes]
+
+@api_router.get("/notes/{note_id}/breadcrumbs", response_model=List[NoteSummaryResponse])
+async def get_note_breadcrumbs(note_id: str, user: dict = Depends(get_current_user)):
+    """The path from the root down to (and including) the note."""
+    await ensure_note_ancestors(user["id"])
+    found = await db.notes.aggregate([
+        {"$match": {"id": note_id, "user_id": user["id"]}},
+        {"$lookup": {"from": "notes", "localField": "ancestors", "foreignField": "id", "as": "path"}},
+        {"$project": {"_id": 0, "content": 0, "content_text": 0, "path._id": 0, "path.content": 0, "path.content_text": 0}},
+    ]).to_list(1)
+    if not found:
+        raise HTTPException(status_code=404, detail="Note not found")
+    note = found[0]
+    by_id = {n["id"]: n for n in note.pop("path", []) if n.get("user_id") == user["id"]}
+    return [normalize_note(by_id[a]) for a in note["ancestors"] if a in by_id] + [normalize_note(note)]
+
+@api_router.put("/notes/{note_id}/move", response_model=NoteSummaryResponse)
+async def move_note_route(note_id: str, data: NoteMove, user: dict = Depends(get_current_user)):
+    """Move a note, with its subtree, under another note or to the top level."""
+    await move_note(user["id"], note_id, data.parent_id, next_change_seq())
+    side_effects.queue_version_bump(user["id"], "notes")
+    note = await db.notes.find_one({"id": note_id, "user_id": user["id"]}, NOTE_TREE_PROJECTION)
+    return normalize_note(note)
+
+@api_router.delete("/notes/{note_id}/subtree")
+async def delete_note_subtree(note_id: str, user: dict = Depends(get_current_user)):
+    """Delete a note together with all of its descendants."""
+    await ensure_note_ancestors(user["id"])
+    subtree = {"user_id": user["id"], "$or": [{"id": note_id}, {"ancestors": note_id}]}
+    ids = [n["id"] async for n in db.notes.find(subtree, {"_id": 0, "id": 1})]
+    if note_id not in ids:
+        raise HTTPException(status_code=404, detail="Note not found")
+    result = await db.notes.delete_many(subtree)
+    await record_deletions(user["id"], "notes", ids, next_change_seq())
+    side_effects.queue_version_bump(user["id"], "notes")
+    await side_effects.enqueue(user["id"], stats={"notes_total": -result.deleted_count})
+    return {"message": "Notes deleted", "count": result.deleted_count}
+
 @api_router.get("/notes/{note_id}", response_model=NoteResponse)
 async def get_note(note_id: str, user: dict = Depends(get_current_user)):
     note = await db.notes.find_one({"id": note_id, "user_id": user["id"]}, {"_id": 0})
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
-    if "categories" not in note:
-        note["categories"] = [note.pop("category", "general")] if isinstance(note.get("category"), str) else note.get("category", ["general"])
-    return note
+    return normalize_note(note)
+
+def revision_filter(revision: int) -> dict:
+    """Match a note at `revision`; notes saved before revisions existed count as 0."""
+    return {"revision": {"$in": [0, None]}} if revision == 0 else {"revision": revision}
+
+def apply_text_patch(text: str, ops: List[NotePatchOp]) -> str:
+    """Apply splice ops in order, each against the result of the previous one."""
+    try:
+        buffer = bytearray(text.encode("utf-16-le", "surrogatepass"))
+        for op in ops:
+            start, end = op.start * 2, (op.start + op.delete) * 2
+            if end > len(buffer):
+                raise HTTPException(status_code=422, detail=f"Patch op at {op.start} is out of range")
+            buffer[start:end] = op.insert.encode("utf-16-le", "surrogatepass")
+        return buffer.decode("utf-16-le")
+    except UnicodeError:
+        raise HTTPException(status_code=422, detail="Patch splits a surrogate pair")
+
+async def _revision_conflict(note_id: str, user_id: str) -> HTTPException:
+    current = await db.notes.find_one({"id": note_id, "user_id": user_id}, {"_id": 0, "revision": 1})
+    if not current:
+        return HTTPException(status_code=404, detail="Note not found")
+    return HTTPException(status_code=409, detail=f"Note has changed; current revision is {current.get('revision', 0)}")
 
 @api_router.put("/notes/{note_id}", response_model=NoteResponse)
 async def update_note(note_id: str, data: NoteUpdate, user: dict = Depends(get_current_user)):
-    note = await db.notes.find_one({"id": note_id, "user_id": user["id"]}, {"_id": 0})
-    if not note:
-        raise HTTPException(status_code=404, detail="Note not found")
-    
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
+    base_revision = update_data.pop("base_revision", None)
     update_data["updated_at"] = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
+    update_data["sync_seq"] = next_change_seq()
+    move = None
+    if "parent_id" in update_data:
+        # Validate now, but only re-parent as part of the guarded update below
+        move = await plan_note_move(user["id"], note_id, update_data["parent_id"])
+        update_data["ancestors"] = move[1]
     
-    await db.notes.update_one({"id": note_id}, {"$set": update_data})
-    
-    updated_note = await db.notes.find_one({"id": note_id}, {"_id": 0})
-    if "categories" not in updated_note:
-        updated_note["categories"] = [updated_note.pop("category", "general")] if isinstance(updated_note.get("category"), str) else updated_note.get("category", ["general"])
-    return updated_note
+    query = {"id": note_id, "user_id": user["id"]}
+    if base_revision is not None:
+        query.update(revision_filter(base_revision))
+    update = {"$set": update_data}
+    if "content" in update_data:
+        # Revisions count content changes, so renames don't invalidate pending patches
+        update["$inc"] = {"revision": 1}
+        update_data["content_text"] = html_to_text(update_data["content"])
+    updated_note = await db.notes.find_one_and_update(
+        query,
+        update,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not updated_note:
+        if base_revision is not None:
+            raise await _revision_conflict(note_id, user["id"])
+        raise HTTPException(status_code=404, detail="Note not found")
+    if move:
+        # Re-parenting rewrites the subtree's ancestors
+        await move_descendants(user["id"], note_id, *move, update_data["sync_seq"])
+    side_effects.queue_version_bump(user["id"], "notes")
+    return normalize_note(updated_note)
+
+@api_router.patch("/notes/{note_id}/content", response_model=NotePatchResponse)
+async def patch_note_content(note_id: str, data: NoteContentPatch, user: dict = Depends(get_current_user)):
+    """Apply text splice ops to a note's content instead of resending all of it.
+
+    The patch must be based on the note's current revision; otherwise it's
+    rejected with 409 and the client should refetch or fall back to PUT.
+    """
+    owner = {"id": note_id, "user_id": user["id"]}
+    note = await db.notes.find_one(owner, {"_id": 0, "content": 1, "revision": 1})
+    if not note:
+        raise HTTPException(status_code=404, detail="Note not found")
+    if note.get("revision", 0) != data.base_revision:
+        raise HTTPException(status_code=409, detail=f"Note has changed; current revision is {note.get('revision', 0)}")
+
+    content = await run_in_threadpool(apply_text_patch, note.get("content") or "", data.ops)
+    updated = await db.notes.find_one_and_update(
+        {**owner, **revision_filter(data.base_revision)},
+        {
+            "$set": {
+                "content": content,
+                "content_text": html_to_text(content),
+                "updated_at": datetime.now(ZoneInfo("Asia/Kolkata")).isoformat(),
+                "sync_seq": next_change_seq(),
+            },
+            "$inc": {"revision": 1},
+        },
+        projection={"_id": 0, "id": 1, "revision": 1, "updated_at": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not updated:
+        # Another save landed between the read and the write
+        raise await _revision_conflict(note_id, user["id"])
+    side_effects.queue_version_bump(user["id"], "notes")
+    return NotePatchResponse(**updated, length=len(content.encode("utf-16-le", "surrogatepass")) // 2)
 
 @api_router.delete("/notes/{note_id}")
 async def delete_note(note_id: str, user: dict = Depends(get_current_user)):
@@ -909,70 +2217,193 @@ async def delete_note(note_id: str, user: dict = Depends(get_current_user)):
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
-    # Get the deleted note's parent_id (could be None if it's a root note)
-    deleted_parent_id = note.get("parent_id")
+    await remove_note(user["id"], note, next_change_seq())
+    side_effects.queue_version_bump(user["id"], "notes")
+    await side_effects.enqueue(user["id"], stats={"notes_total": -1})
+    return {"message": "Note deleted"}
 
-    # Find all children of the note being deleted
-    children = await db.notes.find(
-        {"parent_id": note_id, "user_id": user["id"]}, {"_id": 0}
-    ).sort("created_at", 1).to_list(1000)
+async def remove_note(user_id: str, note: dict, seq: int):
+    """Delete a note, promoting its first child into its place in the tree."""
+    note_id = note["id"]
+    await ensure_note_ancestors(user_id)
 
-    if children:
-        # First child becomes the new parent for its siblings
-        first_child = children[0]
+    # First child (by creation) takes the deleted note's place; its siblings move under it
+    first_child = await db.notes.find_one(
+        {"parent_id": note_id, "user_id": user_id}, {"_id": 0, "id": 1}, sort=[("created_at", 1)]
+    )
+    if first_child:
         first_child_id = first_child["id"]
-
-        # Update first child's parent to deleted note's parent (promotes it up)
-        await db.notes.update_one(
-            {"id": first_child_id},
-            {"$set": {"parent_id": deleted_parent_id}}
+        in_first_subtree = {"$or": [{"$eq": ["$id", first_child_id]}, {"$in": [first_child_id, "$ancestors"]}]}
+        await db.notes.update_many(
+            {"user_id": user_id, "ancestors": note_id},
+            [{"$set": {
+                "parent_id": {"$cond": [
+                    {"$ne": ["$parent_id", note_id]},
+                    "$parent_id",
+                    {"$cond": [{"$eq": ["$id", first_child_id]}, {"$literal": note.get("parent_id")}, first_child_id]},
+                ]},
+                # The first child's subtree loses the deleted note from its path;
+                # every other descendant finds the first child in its place
+                "ancestors": {"$cond": [
+                    in_first_subtree,
+                    {"$filter": {"input": "$ancestors", "cond": {"$ne": ["$$this", note_id]}}},
+                    {"$map": {"input": "$ancestors", "in": {"$cond": [{"$eq": ["$$this", note_id]}, first_child_id, "$$this"]}}},
+                ]},
+                "sync_seq": {"$literal": seq},
+            }}],
         )
 
-        # Update remaining children to have first child as their new parent
-        if len(children) > 1:
-            sibling_ids = [c["id"] for c in children[1:]]
-            await db.notes.update_many(
-                {"id": {"$in": sibling_ids}},
-                {"$set": {"parent_id": first_child_id}}
-            )
-
-    # Delete the note
-    await db.notes.delete_one({"id": note_id})
-    return {"message": "Note deleted"}
+    await db.notes.delete_one({"id": note_id, "user_id": user_id})
+    await record_deletions(user_id, "notes", [note_id], seq)
 
 # ============ BUDGET SHEETS ROUTES ============
 
+# --- Sheet totals ---
+# Each sheet carries materialized total_credit, total_debit, row_count and
+# last_order (highest row order handed out). Sheets created before these
+# fields existed are rebuilt from their rows the first time they're touched.
+
+def _empty_sheet_totals() -> dict:
+    return {"total_credit": 0, "total_debit": 0, "row_count": 0, "last_order": -1}
+
+async def reconcile_sheet_totals(sheet_id: str, user_id: str, seq: Optional[int] = None) -> Optional[dict]:
+    """Rebuild a sheet's totals from its rows. Returns None if the sheet doesn't exist.
+
+    The rebuilt sheet is stamped and its version moved like any other sheet
+    write, so delta syncs and ETags pick up the backfilled fields.
+    """
+    aggregated = await db.budget_rows.aggregate([
+        {"$match": {"sheet_id": sheet_id, "user_id": user_id}},
+        {"$group": {
+            "_id": None,
+            "total_credit": {"$sum": "$credit"},
+            "total_debit": {"$sum": "$debit"},
+            "row_count": {"$sum": 1},
+            "last_order": {"$max": "$order"},
+        }},
+    ]).to_list(1)
+    totals = _empty_sheet_totals()
+    if aggregated:
+        totals.update({k: v for k, v in aggregated[0].items() if k != "_id" and v is not None})
+    result = await db.budget_sheets.update_one(
+        {"id": sheet_id, "user_id": user_id},
+        {"$set": {**totals, "sync_seq": seq if seq is not None else next_change_seq()}},
+    )
+    if not result.matched_count:
+        return None
+    side_effects.queue_version_bump(user_id, "budget_sheets")
+    return totals
+
+async def reserve_sheet_rows(sheet_id: str, user_id: str, count: int, credit: float = 0, debit: float = 0,
+                             seq: Optional[int] = None) -> Optional[dict]:
+    """Claim `count` row orders and add their amounts before inserting them.
+
+    Returns the updated sheet; the new rows take orders
+    last_order - count + 1 .. last_order. None means the sheet doesn't exist.
+    """
+    update = {"$inc": {"row_count": count, "last_order": count, "total_credit": credit, "total_debit": debit}}
+    if seq is not None:
+        update["$set"] = {"sync_seq": seq}
+    for attempt in range(2):
+        sheet = await db.budget_sheets.find_one_and_update(
+            {"id": sheet_id, "user_id": user_id, "row_count": {"$exists": True}},
+            update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+        if sheet or attempt or await reconcile_sheet_totals(sheet_id, user_id, seq) is None:
+            return sheet
+    return None
+
+async def adjust_sheet_totals(sheet_id: str, user_id: str, seq: Optional[int] = None, **deltas: float):
+    """Apply deltas for a row write that has already landed."""
+    deltas = {field: value for field, value in deltas.items() if value}
+    if not deltas:
+        return
+    update = {"$inc": deltas}
+    if seq is not None:
+        update["$set"] = {"sync_seq": seq}
+    result = await db.budget_sheets.update_one(
+        {"id": sheet_id, "user_id": user_id, "row_count": {"$exists": True}},
+        update,
+    )
+    if result.matched_count == 0:
+        # Legacy sheet: rebuilding from rows already reflects this write
+        await reconcile_sheet_totals(sheet_id, user_id, seq)
+
+async def raise_last_row_order(sheet_id: str, user_id: str, order: int):
+    """Keep later inserts from reusing an order a row was explicitly given."""
+    # Legacy sheets pick last_order up from their rows when reconciled
+    await db.budget_sheets.update_one(
+        {"id": sheet_id, "user_id": user_id, "row_count": {"$exists": True}},
+        {"$max": {"last_order": order}},
+    )
+
 # --- Sheet CRUD ---
 
 @api_router.get("/budget/sheets")
-async def get_sheets(user: dict = Depends(get_current_user)):
+async def get_sheets(request: Request, response: Response, user: dict = Depends(get_current_user)):
+    unchanged = await not_modified(request, response, user["id"], ("budget_sheets",))
+    if unchanged:
+        return unchanged
     sheets = await db.budget_sheets.find({"user_id": user["id"]}, {"_id": 0}).sort("order", 1).to_list(100)
+    legacy = [sheet for sheet in sheets if "row_count" not in sheet]
+    if legacy:
+        rebuilt = await asyncio.gather(*(reconcile_sheet_totals(sheet["id"], user["id"]) for sheet in legacy))
+        for sheet, totals in zip(legacy, rebuilt):
+            sheet.update(totals or _empty_sheet_totals())
     return sheets
 
 @api_router.post("/budget/sheets")
 async def create_sheet(data: BudgetSheetCreate, user: dict = Depends(get_current_user)):
     now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-    count = await db.budget_sheets.count_documents({"user_id": user["id"]})
+    order = await allocate_sequence(
+        "budget_sheets", user["id"],
+        seed=lambda: next_order_after_max(db.budget_sheets, {"user_id": user["id"]}),
+    )
     sheet_doc = {
         "id": str(uuid.uuid4()),
         "user_id": user["id"],
         "name": data.name,
-        "order": count,
-        "created_at": now
+        "order": order,
+        **_empty_sheet_totals(),
+        "created_at": now,
+        "sync_seq": next_change_seq(),
     }
     await db.budget_sheets.insert_one(sheet_doc)
+    side_effects.queue_version_bump(user["id"], "budget_sheets")
     sheet_doc.pop('_id', None)
     return sheet_doc
 
+@api_router.put("/budget/sheets/reorder")
+async def reorder_sheets(data: SheetReorder, user: dict = Depends(get_current_user)):
+    """Reorder sheets from a full id list or sparse moves in one bulk_write."""
+    result = await bulk_reorder(
+        db.budget_sheets, {"user_id": user["id"]}, "order", data.sheet_ids, data.moves,
+        stamp={"sync_seq": next_change_seq()},
+    )
+    if result["max_order"] is not None:
+        await raise_sequence_floor("budget_sheets", user["id"], result["max_order"] + 1)
+    side_effects.queue_version_bump(user["id"], "budget_sheets")
+    return {"message": "Sheets reordered", "matched": result["matched"], "modified": result["modified"]}
+
 @api_router.put("/budget/sheets/{sheet_id}")
 async def update_sheet(sheet_id: str, data: BudgetSheetUpdate, user: dict = Depends(get_current_user)):
-    sheet = await db.budget_sheets.find_one({"id": sheet_id, "user_id": user["id"]})
-    if not sheet:
-        raise HTTPException(status_code=404, detail="Sheet not found")
+    owner = {"id": sheet_id, "user_id": user["id"]}
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     if update_data:
-        await db.budget_sheets.update_one({"id": sheet_id}, {"$set": update_data})
-    updated = await db.budget_sheets.find_one({"id": sheet_id}, {"_id": 0})
+        update_data["sync_seq"] = next_change_seq()
+        updated = await db.budget_sheets.find_one_and_update(
+            owner, {"$set": update_data}, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+    else:
+        updated = await db.budget_sheets.find_one(owner, {"_id": 0})
+    if not updated:
+        raise HTTPException(status_code=404, detail="Sheet not found")
+    if "order" in update_data:
+        await raise_sequence_floor("budget_sheets", user["id"], update_data["order"] + 1)
+    if update_data:
+        side_effects.queue_version_bump(user["id"], "budget_sheets")
     return updated
 
 @api_router.delete("/budget/sheets/{sheet_id}")
@@ -982,150 +2413,477 @@ async def delete_sheet(sheet_id: str, user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=404, detail="Sheet not found")
     await db.budget_rows.delete_many({"sheet_id": sheet_id, "user_id": user["id"]})
     await db.budget_sheets.delete_one({"id": sheet_id})
+    # Rows go with their sheet; clients drop them when the sheet's tombstone arrives
+    await record_deletions(user["id"], "budget_sheets", [sheet_id], next_change_seq())
+    side_effects.queue_version_bump(user["id"], "budget_sheets", "budget_rows")
     return {"message": "Sheet and all its rows deleted"}
 
 # --- Row CRUD ---
 
 @api_router.get("/budget/sheets/{sheet_id}/rows")
-async def get_rows(sheet_id: str, user: dict = Depends(get_current_user)):
-    rows = await db.budget_rows.find({"sheet_id": sheet_id, "user_id": user["id"]}, {"_id": 0}).sort("order", 1).to_list(5000)
-    return rows
-
-@api_router.post("/budget/sheets/{sheet_id}/rows")
-async def create_row(sheet_id: str, data: BudgetRowCreate, user: dict = Depends(get_current_user)):
-    sheet = await db.budget_sheets.find_one({"id": sheet_id, "user_id": user["id"]})
-    if not sheet:
-        raise HTTPException(status_code=404, detail="Sheet not found")
-    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-    count = await db.budget_rows.count_documents({"sheet_id": sheet_id, "user_id": user["id"]})
-    row_doc = {
+async def get_rows(
+    sheet_id: str,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+):
+    query = {"sheet_id": sheet_id, "user_id": user["id"]}
+    if wants_ndjson(request):
+        return stream_ndjson(db.budget_rows, query, {"_id": 0}, "order", 1, limit, cursor)
+    rows = await fetch_page(db.budget_rows, query, {"_id": 0}, "order", 1, limit or 5000, cursor, response)
+    return send_documents(rows, response)
+
+def build_row_doc(user_id: str, sheet_id: str, data: BudgetRowCreate, order: int, now: str) -> dict:
+    return {
         "id": str(uuid.uuid4()),
         "sheet_id": sheet_id,
-        "user_id": user["id"],
+        "user_id": user_id,
         "date": data.date,
         "description": data.description,
         "credit": data.credit,
         "debit": data.debit,
-        "order": count,
+        "order": order,
         "created_at": now
     }
+
+@api_router.post("/budget/sheets/{sheet_id}/rows")
+async def create_row(sheet_id: str, data: BudgetRowCreate, user: dict = Depends(get_current_user)):
+    seq = next_change_seq()
+    sheet = await reserve_sheet_rows(sheet_id, user["id"], 1, credit=data.credit, debit=data.debit, seq=seq)
+    if not sheet:
+        raise HTTPException(status_code=404, detail="Sheet not found")
+    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
+    row_doc = build_row_doc(user["id"], sheet_id, data, sheet["last_order"], now)
+    row_doc["sync_seq"] = seq
     await db.budget_rows.insert_one(row_doc)
+    side_effects.queue_version_bump(user["id"], "budget_sheets", "budget_rows")
     row_doc.pop('_id', None)
     return row_doc
 
+@api_router.put("/budget/sheets/{sheet_id}/rows/reorder")
+async def reorder_rows(sheet_id: str, data: RowReorder, user: dict = Depends(get_current_user)):
+    """Reorder a sheet's rows from a full id list or sparse moves in one bulk_write."""
+    result = await bulk_reorder(
+        db.budget_rows, {"sheet_id": sheet_id, "user_id": user["id"]}, "order", data.row_ids, data.moves,
+        stamp={"sync_seq": next_change_seq()},
+    )
+    if result["max_order"] is not None:
+        await raise_last_row_order(sheet_id, user["id"], result["max_order"])
+    side_effects.queue_version_bump(user["id"], "budget_sheets", "budget_rows")
+    return {"message": "Rows reordered", "matched": result["matched"], "modified": result["modified"]}
+
 @api_router.put("/budget/rows/{row_id}")
 async def update_row(row_id: str, data: BudgetRowUpdate, user: dict = Depends(get_current_user)):
-    row = await db.budget_rows.find_one({"id": row_id, "user_id": user["id"]})
-    if not row:
-        raise HTTPException(status_code=404, detail="Row not found")
+    owner = {"id": row_id, "user_id": user["id"]}
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
+    seq = next_change_seq() if update_data else None
+    if update_data:
+        update_data["sync_seq"] = seq
+    if "credit" in update_data or "debit" in update_data:
+        # Amount changes need the old values to keep the sheet totals in step
+        row = await db.budget_rows.find_one_and_update(
+            owner, {"$set": update_data}, projection={"_id": 0}, return_document=ReturnDocument.BEFORE
+        )
+        if not row:
+            raise HTTPException(status_code=404, detail="Row not found")
+        await adjust_sheet_totals(
+            row["sheet_id"], user["id"], seq=seq,
+            total_credit=update_data.get("credit", row.get("credit", 0)) - row.get("credit", 0),
+            total_debit=update_data.get("debit", row.get("debit", 0)) - row.get("debit", 0),
+        )
+        if "order" in update_data:
+            await raise_last_row_order(row["sheet_id"], user["id"], update_data["order"])
+        side_effects.queue_version_bump(user["id"], "budget_sheets", "budget_rows")
+        return {**row, **update_data}
     if update_data:
-        await db.budget_rows.update_one({"id": row_id}, {"$set": update_data})
-    updated = await db.budget_rows.find_one({"id": row_id}, {"_id": 0})
+        updated = await db.budget_rows.find_one_and_update(
+            owner, {"$set": update_data}, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+    else:
+        updated = await db.budget_rows.find_one(owner, {"_id": 0})
+    if not updated:
+        raise HTTPException(status_code=404, detail="Row not found")
+    if "order" in update_data:
+        await raise_last_row_order(updated["sheet_id"], user["id"], update_data["order"])
+    if update_data:
+        side_effects.queue_version_bump(user["id"], "budget_sheets", "budget_rows")
     return updated
 
 @api_router.delete("/budget/rows/{row_id}")
 async def delete_row(row_id: str, user: dict = Depends(get_current_user)):
-    result = await db.budget_rows.delete_one({"id": row_id, "user_id": user["id"]})
-    if result.deleted_count == 0:
+    row = await db.budget_rows.find_one_and_delete(
+        {"id": row_id, "user_id": user["id"]},
+        projection={"_id": 0, "sheet_id": 1, "credit": 1, "debit": 1},
+    )
+    if not row:
         raise HTTPException(status_code=404, detail="Row not found")
+    seq = next_change_seq()
+    await adjust_sheet_totals(
+        row["sheet_id"], user["id"], seq=seq,
+        row_count=-1, total_credit=-row.get("credit", 0), total_debit=-row.get("debit", 0),
+    )
+    await record_deletions(user["id"], "budget_rows", [row_id], seq)
+    side_effects.queue_version_bump(user["id"], "budget_sheets", "budget_rows")
     return {"message": "Row deleted"}
 
+# --- Analytics ---
+
+def _summarize_budget(columns: dict, window: int, top_categories: int, include_rows: bool) -> dict:
+    """Vectorized sheet analytics over columnar row data (in sheet order)."""
+    credit = np.asarray(columns["credit"], dtype=np.float64)
+    debit = np.asarray(columns["debit"], dtype=np.float64)
+    net = credit - debit
+    balance = np.cumsum(net)
+
+    raw_dates = pd.Series(columns["date"], dtype="string")
+    # ISO dates come from the date picker; anything else is usually a day-first bank export
+    dates = pd.to_datetime(raw_dates, errors="coerce", format="ISO8601")
+    dates = dates.fillna(pd.to_datetime(raw_dates, errors="coerce", format="mixed", dayfirst=True))
+
+    frame = pd.DataFrame({
+        "date": dates,
+        "category": pd.Series(columns["description"], dtype="string").str.strip().str.lower().replace("", "uncategorized").fillna("uncategorized"),
+        "credit": credit,
+        "debit": debit,
+        "net": net,
+        "balance": balance,
+    })
+
+    dated = frame[frame["date"].notna()]
+    monthly = dated.groupby(dated["date"].dt.to_period("M")).agg(
+        credit=("credit", "sum"),
+        debit=("debit", "sum"),
+        net=("net", "sum"),
+        closing_balance=("balance", "last"),
+        rows=("net", "size"),
+    ).sort_index()
+    monthly["net_moving_avg"] = monthly["net"].rolling(window, min_periods=1).mean()
+
+    categories = frame.groupby("category").agg(
+        credit=("credit", "sum"),
+        debit=("debit", "sum"),
+        rows=("net", "size"),
+    ).sort_values(["debit", "credit"], ascending=False).head(top_categories)
+
+    summary = {
+        "row_count": int(len(frame)),
+        "undated_rows": int(len(frame) - len(dated)),
+        "total_credit": round(float(credit.sum()), 2),
+        "total_debit": round(float(debit.sum()), 2),
+        "balance": round(float(balance[-1]), 2) if len(balance) else 0.0,
+        "min_balance": round(float(balance.min()), 2) if len(balance) else 0.0,
+        "max_balance": round(float(balance.max()), 2) if len(balance) else 0.0,
+        "monthly": [
+            {
+                "month": str(period),
+                "credit": round(float(row.credit), 2),
+                "debit": round(float(row.debit), 2),
+                "net": round(float(row.net), 2),
+                "closing_balance": round(float(row.closing_balance), 2),
+                "net_moving_avg": round(float(row.net_moving_avg), 2),
+                "rows": int(row.rows),
+            }
+            for period, row in monthly.iterrows()
+        ],
+        "categories": [
+            {"category": str(name), "credit": round(float(row.credit), 2), "debit": round(float(row.debit), 2), "rows": int(row.rows)}
+            for name, row in categories.iterrows()
+        ],
+    }
+    if include_rows:
+        summary["running_balance"] = {"ids": columns["id"], "balance": np.round(balance, 2).tolist()}
+    return summary
+
+@api_router.get("/budget/sheets/{sheet_id}/summary")
+async def get_sheet_summary(
+    sheet_id: str,
+    window: int = Query(3, ge=1, le=24),
+    top_categories: int = Query(20, ge=1, le=200),
+    include_rows: bool = False,
+    user: dict = Depends(get_current_user),
+):
+    """Running balance, monthly totals, category rollups and moving averages for a sheet.
+
+    `window` is the moving-average span in months; `include_rows` adds the
+    per-row running balance as parallel id/balance arrays.
+    """
+    sheet = await db.budget_sheets.find_one({"id": sheet_id, "user_id": user["id"]}, {"_id": 1})
+    if not sheet:
+        raise HTTPException(status_code=404, detail="Sheet not found")
+
+    columns = {"id": [], "date": [], "description": [], "credit": [], "debit": []}
+    rows = db.budget_rows.find(
+        {"sheet_id": sheet_id, "user_id": user["id"]},
+        {"_id": 0, "id": 1, "date": 1, "description": 1, "credit": 1, "debit": 1},
+    ).sort("order", 1).batch_size(EXPORT_BATCH_ROWS)
+    async for r in rows:
+        columns["id"].append(r["id"])
+        columns["date"].append(r.get("date") or None)
+        columns["description"].append(r.get("description") or "")
+        columns["credit"].append(r.get("credit") or 0)
+        columns["debit"].append(r.get("debit") or 0)
+
+    return await run_in_threadpool(_summarize_budget, columns, window, top_categories, include_rows)
+
 # --- Import / Export ---
 
+def _detect_csv_encoding(raw_file) -> str:
+    """Scan the spooled upload once in chunks to choose between UTF-8 and Latin-1."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    raw_file.seek(0)
+    try:
+        while True:
+            chunk = raw_file.read(64 * 1024)
+            if not chunk:
+                break
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return "latin-1"
+    finally:
+        raw_file.seek(0)
+    return "utf-8-sig"
+
+def _read_csv_batch(reader, size: int) -> list:
+    """Pull up to `size` records from the reader as (line number, row) pairs."""
+    batch = []
+    for row in reader:
+        batch.append((reader.line_num, row))
+        if len(batch) >= size:
+            break
+    return batch
+
+def _parse_budget_csv_row(row: dict):
+    """Map a CSV record onto row fields. Returns (fields, error); both None for blank lines."""
+    row = {k.strip().lower(): (v or "").strip() for k, v in row.items() if k}
+
+    raw_date = row.get('date', '').strip()
+    description = row.get('source', row.get('description', '')).strip()
+
+    amounts = {}
+    for column in ("debit", "credit"):
+        raw_amount = row.get(column, '').replace(',', '').strip()
+        try:
+            amounts[column] = float(raw_amount) if raw_amount else 0
+        except ValueError:
+            return None, f"Invalid {column} amount '{raw_amount}'"
+
+    if not raw_date and not description and amounts["debit"] == 0 and amounts["credit"] == 0:
+        return None, None
+
+    return {"date": raw_date, "description": description, **amounts}, None
+
 @api_router.post("/budget/sheets/{sheet_id}/import")
 async def import_sheet_csv(sheet_id: str, file: UploadFile = File(...), user: dict = Depends(get_current_user)):
-    """Import CSV into a sheet. Columns: date, source/description, debit, credit"""
+    """Import CSV into a sheet. Columns: date, source/description, debit, credit
+
+    The upload is parsed incrementally and inserted in batches of
+    IMPORT_BATCH_ROWS, so memory stays bounded for large statements. Rows
+    that fail to parse or insert are skipped and reported by line number.
+    """
     sheet = await db.budget_sheets.find_one({"id": sheet_id, "user_id": user["id"]})
     if not sheet:
         raise HTTPException(status_code=404, detail="Sheet not found")
     try:
-        content = await file.read()
-        try:
-            text = content.decode('utf-8-sig')
-        except UnicodeDecodeError:
-            text = content.decode('latin-1')
-        
-        reader = csv.DictReader(io.StringIO(text))
-        
+        encoding = await run_in_threadpool(_detect_csv_encoding, file.file)
+        text = io.TextIOWrapper(file.file, encoding=encoding, newline="")
+        reader = csv.DictReader(text)
+
         imported = 0
-        rows_to_insert = []
+        batches = []
+        errors = []
+        error_count = 0
+        complete = True
         now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-        current_order = await db.budget_rows.count_documents({"sheet_id": sheet_id, "user_id": user["id"]})
-        
-        for row in reader:
-            row = {k.strip().lower(): v.strip() for k, v in row.items() if k}
-            
-            raw_date = row.get('date', '').strip()
-            description = row.get('source', row.get('description', '')).strip()
-            
-            debit_str = row.get('debit', '').replace(',', '').strip()
-            credit_str = row.get('credit', '').replace(',', '').strip()
-            
-            debit = 0
-            credit = 0
-            try:
-                debit = float(debit_str) if debit_str else 0
-            except ValueError:
-                pass
-            try:
-                credit = float(credit_str) if credit_str else 0
-            except ValueError:
-                pass
-            
-            if not raw_date and not description and debit == 0 and credit == 0:
-                continue
-            
-            row_doc = {
-                "id": str(uuid.uuid4()),
-                "sheet_id": sheet_id,
-                "user_id": user["id"],
-                "date": raw_date,
-                "description": description,
-                "credit": credit,
-                "debit": debit,
-                "order": current_order + imported,
-                "created_at": now
-            }
-            
-            rows_to_insert.append(row_doc)
-            imported += 1
 
-        # Batch insert all rows at once for better performance
-        if rows_to_insert:
-            await db.budget_rows.insert_many(rows_to_insert)
-        
-        return {"message": f"Imported {imported} rows", "count": imported}
+        def record_error(line: int, message: str):
+            nonlocal error_count
+            error_count += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line, "error": message})
+
+        try:
+            while True:
+                try:
+                    records = await run_in_threadpool(_read_csv_batch, reader, IMPORT_BATCH_ROWS)
+                except csv.Error as e:
+                    record_error(reader.line_num, f"Malformed CSV: {e}")
+                    complete = False
+                    break
+                if not records:
+                    break
+
+                parsed = []
+                lines = []
+                failed = 0
+                for line, row in records:
+                    fields, error = _parse_budget_csv_row(row)
+                    if error:
+                        record_error(line, error)
+                        failed += 1
+                        continue
+                    if fields is None:
+                        continue
+                    parsed.append(fields)
+                    lines.append(line)
+
+                inserted = 0
+                if parsed:
+                    seq = next_change_seq()
+                    sheet = await reserve_sheet_rows(
+                        sheet_id, user["id"], len(parsed),
+                        credit=sum(fields["credit"] for fields in parsed),
+                        debit=sum(fields["debit"] for fields in parsed),
+                        seq=seq,
+                    )
+                    if not sheet:
+                        raise HTTPException(status_code=404, detail="Sheet not found")
+                    first_order = sheet["last_order"] - len(parsed) + 1
+                    rows_to_insert = [
+                        {
+                            "id": str(uuid.uuid4()),
+                            "sheet_id": sheet_id,
+                            "user_id": user["id"],
+                            **fields,
+                            "order": first_order + offset,
+                            "created_at": now,
+                            "sync_seq": seq,
+                        }
+                        for offset, fields in enumerate(parsed)
+                    ]
+                    try:
+                        result = await db.budget_rows.insert_many(rows_to_insert, ordered=False)
+                        inserted = len(result.inserted_ids)
+                    except BulkWriteError as e:
+                        inserted = e.details.get("nInserted", 0)
+                        write_errors = e.details.get("writeErrors", [])
+                        for write_error in write_errors:
+                            record_error(lines[write_error["index"]], write_error.get("errmsg", "Insert failed"))
+                        failed += len(write_errors)
+                        lost = [rows_to_insert[write_error["index"]] for write_error in write_errors]
+                        await adjust_sheet_totals(
+                            sheet_id, user["id"], seq=seq,
+                            row_count=-len(lost),
+                            total_credit=-sum(r["credit"] for r in lost),
+                            total_debit=-sum(r["debit"] for r in lost),
+                        )
+                    side_effects.queue_version_bump(user["id"], "budget_sheets", "budget_rows")
+
+                imported += inserted
+                batches.append({"batch": len(batches) + 1, "inserted": inserted, "failed": failed, "last_line": records[-1][0]})
+        finally:
+            text.detach()
+
+        return {
+            "message": f"Imported {imported} rows",
+            "count": imported,
+            "complete": complete,
+            "batches": batches,
+            "errors": errors,
+            "errors_truncated": error_count > len(errors),
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"CSV import error: {e}")
         raise HTTPException(status_code=400, detail=f"Failed to parse CSV: {str(e)}")
 
+EXPORT_COLUMNS = ["Date", "Description", "Credit", "Debit"]
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+def _export_cursor(sheet_id: str, user_id: str):
+    return db.budget_rows.find(
+        {"sheet_id": sheet_id, "user_id": user_id},
+        {"_id": 0, "date": 1, "description": 1, "credit": 1, "debit": 1},
+    ).sort("order", 1).batch_size(EXPORT_BATCH_ROWS)
+
+async def _csv_chunks(sheet_id: str, user_id: str):
+    """Yield the sheet as CSV, one encoded chunk per EXPORT_BATCH_ROWS rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    pending = 0
+    async for r in _export_cursor(sheet_id, user_id):
+        writer.writerow([r.get("date", ""), r.get("description", ""), r.get("credit", 0), r.get("debit", 0)])
+        pending += 1
+        if pending >= EXPORT_BATCH_ROWS:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue().encode("utf-8")
+
+async def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # wbits=31 writes a gzip container
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def _render_table(columns: dict, fmt: str) -> bytes:
+    frame = pd.DataFrame(columns, columns=EXPORT_COLUMNS)
+    output = io.BytesIO()
+    if fmt == "xlsx":
+        frame.to_excel(output, index=False, sheet_name="Budget")
+    else:
+        frame.to_parquet(output, index=False)
+    return output.getvalue()
+
 @api_router.get("/budget/sheets/{sheet_id}/export")
-async def export_sheet_csv(sheet_id: str, user: dict = Depends(get_current_user)):
-    from fastapi.responses import StreamingResponse
+async def export_sheet_csv(
+    sheet_id: str,
+    fmt: str = Query("csv", alias="format"),
+    gzip: bool = False,
+    user: dict = Depends(get_current_user),
+):
+    """Export a sheet as CSV (streamed, optionally gzipped), XLSX or Parquet."""
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format '{fmt}'. Use one of: {', '.join(EXPORT_FORMATS)}")
     sheet = await db.budget_sheets.find_one({"id": sheet_id, "user_id": user["id"]})
     if not sheet:
         raise HTTPException(status_code=404, detail="Sheet not found")
     
-    rows = await db.budget_rows.find({"sheet_id": sheet_id, "user_id": user["id"]}, {"_id": 0}).sort("order", 1).to_list(5000)
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Date", "Description", "Credit", "Debit"])
-    for r in rows:
-        writer.writerow([r.get("date", ""), r.get("description", ""), r.get("credit", 0), r.get("debit", 0)])
-    
-    output.seek(0)
-    filename = f"{sheet['name'].replace(' ', '_')}.csv"
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
+    media_type, extension = EXPORT_FORMATS[fmt]
+    filename = f"{sheet['name'].replace(' ', '_')}.{extension}"
+
+    if fmt == "csv":
+        chunks = _csv_chunks(sheet_id, user["id"])
+        if gzip:
+            chunks = _gzip_chunks(chunks)
+            media_type = "application/gzip"
+            filename += ".gz"
+        return StreamingResponse(
+            chunks,
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+
+    # Binary spreadsheet formats can't be written incrementally; collect columns
+    # (not row dicts) and render off the event loop.
+    columns = {name: [] for name in EXPORT_COLUMNS}
+    async for r in _export_cursor(sheet_id, user["id"]):
+        columns["Date"].append(r.get("date", ""))
+        columns["Description"].append(r.get("description", ""))
+        columns["Credit"].append(r.get("credit", 0))
+        columns["Debit"].append(r.get("debit", 0))
+    try:
+        content = await run_in_threadpool(_render_table, columns, fmt)
+    except ImportError as e:
+        raise HTTPException(status_code=501, detail=f"{fmt.upper()} export is not available on this server: {e}")
+    return Response(
+        content,
+        media_type=media_type,
         headers={"Content-Disposition": f'attachment; filename="{filename}"'}
     )
 
 
-
-
 # ============ FOCUS ROUTES ============
 
 @api_router.post("/focus/start", response_model=FocusSessionResponse)
@@ -1170,28 +2928,45 @@ async def complete_focus_session(session_id: str, data: FocusSessionComplete, us
     if data.duration_actual > max_allowed_duration:
         raise HTTPException(status_code=400, detail="Reported duration exceeds the allowed session time")
     
-    await db.focus_sessions.update_one(
-        {"id": session_id},
+    updated_session = await db.focus_sessions.find_one_and_update(
+        {"id": session_id, "user_id": user["id"], "completed_at": None},
         {"$set": {
             "duration_actual": data.duration_actual,
             "completed_at": now,
             "interrupted": data.interrupted,
-        }}
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
     )
+    if not updated_session:
+        # Completed by a concurrent request after the checks above
+        raise HTTPException(status_code=409, detail="Session already completed")
     
     # Only award XP and update stats for naturally completed sessions
     if not data.interrupted:
-        await add_xp(user["id"], 25)
-        await update_daily_activity(user["id"], "focus_time", data.duration_actual)
-        await update_streak(user["id"])
-        await check_achievements(user["id"])
+        await side_effects.enqueue(
+            user["id"],
+            xp=25,
+            activity={"focus_time": data.duration_actual},
+            stats={"focus_sessions_total": 1, "focus_minutes_total": data.duration_actual},
+            streak=True,
+            achievements=True,
+        )
     
-    updated_session = await db.focus_sessions.find_one({"id": session_id}, {"_id": 0})
     return updated_session
 
 @api_router.get("/focus/sessions", response_model=List[FocusSessionResponse])
-async def get_focus_sessions(user: dict = Depends(get_current_user)):
-    sessions = await db.focus_sessions.find({"user_id": user["id"]}, {"_id": 0}).sort("started_at", -1).to_list(100)
+async def get_focus_sessions(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+):
+    query = {"user_id": user["id"]}
+    if wants_ndjson(request):
+        return stream_ndjson(db.focus_sessions, query, {"_id": 0}, "started_at", -1, limit, cursor)
+    sessions = await fetch_page(db.focus_sessions, query, {"_id": 0}, "started_at", -1, limit or 100, cursor, response)
     return sessions
 
 @api_router.get("/focus/stats")
@@ -1212,61 +2987,86 @@ async def get_focus_stats(user: dict = Depends(get_current_user)):
 
 # ============ HABIT ROUTES ============
 
+def apply_effective_completion(habit: dict, today: str) -> dict:
+    """A habit only counts as completed on the day it was last completed.
+
+    Stale flags from previous days are left in the database and masked here,
+    so reading habits never needs to write.
+    """
+    if habit.get("is_completed", False) and habit.get("last_completed_date") != today:
+        habit["is_completed"] = False
+    return habit
+
 @api_router.get("/habits", response_model=List[HabitResponse])
-async def get_habits(user: dict = Depends(get_current_user)):
-    """Get all habits for user. Auto-resets completion status if new day."""
-    today = datetime.now(ZoneInfo("Asia/Kolkata")).strftime("%Y-%m-%d")
+async def get_habits(request: Request, response: Response, user: dict = Depends(get_current_user)):
+    """Get all habits for user. Completion status resets automatically each new day."""
+    midnight = datetime.now(ZoneInfo("Asia/Kolkata")).replace(hour=0, minute=0, second=0, microsecond=0)
+    unchanged = await not_modified(request, response, user["id"], ("habits",), valid_from=midnight)
+    if unchanged:
+        return unchanged
+    today = midnight.strftime("%Y-%m-%d")
     habits = await db.habits.find({"user_id": user["id"]}, {"_id": 0}).sort("order", 1).to_list(100)
-    
-    updated_habits = []
-    for habit in habits:
-        # Auto-reset if last_completed_date is not today and is_completed is True
-        last_date = habit.get("last_completed_date", "")
-        if habit.get("is_completed", False) and last_date != today:
-            # Reset to pending (new day)
-            await db.habits.update_one(
-                {"id": habit["id"]},
-                {"$set": {"is_completed": False}}
-            )
-            habit["is_completed"] = False
-        updated_habits.append(habit)
-    
-    return updated_habits
+    return [apply_effective_completion(habit, today) for habit in habits]
 
-@api_router.post("/habits", response_model=HabitResponse)
-async def create_habit(data: HabitCreate, user: dict = Depends(get_current_user)):
-    """Create a new habit."""
-    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-    habit_id = str(uuid.uuid4())
-    
-    # Get max order for user's habits
-    max_order_habit = await db.habits.find_one(
-        {"user_id": user["id"]},
-        sort=[("order", -1)]
+async def allocate_habit_orders(user_id: str, count: int = 1) -> int:
+    return await allocate_sequence(
+        "habits", user_id, count,
+        seed=lambda: next_order_after_max(db.habits, {"user_id": user_id}),
     )
-    next_order = (max_order_habit.get("order", 0) + 1) if max_order_habit else 0
-    
-    habit_doc = {
-        "id": habit_id,
-        "user_id": user["id"],
+
+def build_habit_doc(user_id: str, data: HabitCreate, order: int, now: str) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
         "title": data.title,
         "icon": data.icon or "☀️",
-        "order": data.order if data.order is not None else next_order,
+        "order": order,
         "is_completed": False,
         "last_completed_date": None,
         "current_streak": 0,
         "created_at": now
     }
+
+@api_router.post("/habits", response_model=HabitResponse)
+async def create_habit(data: HabitCreate, user: dict = Depends(get_current_user)):
+    """Create a new habit."""
+    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
+    
+    order = data.order
+    if order is None:
+        order = await allocate_habit_orders(user["id"])
+    
+    habit_doc = build_habit_doc(user["id"], data, order, now)
+    habit_doc["sync_seq"] = next_change_seq()
     
     await db.habits.insert_one(habit_doc)
+    if data.order is not None:
+        await raise_sequence_floor("habits", user["id"], order + 1)
+    side_effects.queue_version_bump(user["id"], "habits")
     return HabitResponse(**habit_doc)
 
+@api_router.put("/habits/reorder")
+async def reorder_habits(data: HabitReorder, user: dict = Depends(get_current_user)):
+    """Reorder habits by providing list of habit IDs in desired order. Uses bulk_write for efficiency."""
+    if not data.habit_ids:
+        return {"message": "Habits reordered"}
+    seq = next_change_seq()
+    operations = [
+        UpdateOne(
+            {"id": habit_id, "user_id": user["id"]},
+            {"$set": {"order": index, "sync_seq": seq}}
+        )
+        for index, habit_id in enumerate(data.habit_ids)
+    ]
+    await db.habits.bulk_write(operations)
+    side_effects.queue_version_bump(user["id"], "habits")
+    return {"message": "Habits reordered"}
+
 @api_router.put("/habits/{habit_id}", response_model=HabitResponse)
 async def update_habit(habit_id: str, data: HabitUpdate, user: dict = Depends(get_current_user)):
     """Update a habit. Toggle completion updates streak."""
-    habit = await db.habits.find_one({"id": habit_id, "user_id": user["id"]}, {"_id": 0})
-    if not habit:
-        raise HTTPException(status_code=404, detail="Habit not found")
+    owner = {"id": habit_id, "user_id": user["id"]}
+    today = datetime.now(ZoneInfo("Asia/Kolkata")).strftime("%Y-%m-%d")
     
     update_data = {}
     if data.title is not None:
@@ -1275,32 +3075,43 @@ async def update_habit(habit_id: str, data: HabitUpdate, user: dict = Depends(ge
         update_data["icon"] = data.icon
     if data.order is not None:
         update_data["order"] = data.order
+    if update_data or data.is_completed is not None:
+        update_data["sync_seq"] = next_change_seq()
     
-    # Handle completion toggle with streak logic
-    if data.is_completed is not None:
-        today = datetime.now(ZoneInfo("Asia/Kolkata")).strftime("%Y-%m-%d")
+    if data.is_completed:
+        # Marking as complete. The streak depends on the stored
+        # last_completed_date, so it's computed inside the update: increment if
+        # last completed yesterday, keep if already done today, otherwise reset to 1.
         yesterday = (datetime.now(ZoneInfo("Asia/Kolkata")) - timedelta(days=1)).strftime("%Y-%m-%d")
-        
-        if data.is_completed:
-            # Marking as complete
-            update_data["is_completed"] = True
-            update_data["last_completed_date"] = today
-            
-            # Update streak: if last completed was yesterday, increment; otherwise reset to 1
-            last_date = habit.get("last_completed_date", "")
-            if last_date == yesterday:
-                update_data["current_streak"] = habit.get("current_streak", 0) + 1
-            elif last_date != today:
-                update_data["current_streak"] = 1
-        else:
+        fields = literal_set({**update_data, "is_completed": True, "last_completed_date": today})
+        fields["current_streak"] = {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$last_completed_date", yesterday]}, "then": {"$add": [{"$ifNull": ["$current_streak", 0]}, 1]}},
+                {"case": {"$ne": ["$last_completed_date", today]}, "then": 1},
+            ],
+            "default": {"$ifNull": ["$current_streak", 0]},
+        }}
+        updated_habit = await db.habits.find_one_and_update(
+            owner, [{"$set": fields}], projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+    else:
+        if data.is_completed is not None:
             # Marking as incomplete (undo)
             update_data["is_completed"] = False
+        if update_data:
+            updated_habit = await db.habits.find_one_and_update(
+                owner, {"$set": update_data}, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+            )
+        else:
+            updated_habit = await db.habits.find_one(owner, {"_id": 0})
     
-    if update_data:
-        await db.habits.update_one({"id": habit_id}, {"$set": update_data})
-    
-    updated_habit = await db.habits.find_one({"id": habit_id}, {"_id": 0})
-    return HabitResponse(**updated_habit)
+    if not updated_habit:
+        raise HTTPException(status_code=404, detail="Habit not found")
+    if data.order is not None:
+        await raise_sequence_floor("habits", user["id"], data.order + 1)
+    if "sync_seq" in update_data:
+        side_effects.queue_version_bump(user["id"], "habits")
+    return HabitResponse(**apply_effective_completion(updated_habit, today))
 
 @api_router.delete("/habits/{habit_id}")
 async def delete_habit(habit_id: str, user: dict = Depends(get_current_user)):
@@ -1308,94 +3119,575 @@ async def delete_habit(habit_id: str, user: dict = Depends(get_current_user)):
     result = await db.habits.delete_one({"id": habit_id, "user_id": user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Habit not found")
+    await record_deletions(user["id"], "habits", [habit_id], next_change_seq())
+    side_effects.queue_version_bump(user["id"], "habits")
     return {"message": "Habit deleted"}
 
-@api_router.put("/habits/reorder")
-async def reorder_habits(data: HabitReorder, user: dict = Depends(get_current_user)):
-    """Reorder habits by providing list of habit IDs in desired order. Uses bulk_write for efficiency."""
-    if not data.habit_ids:
-        return {"message": "Habits reordered"}
-    operations = [
-        UpdateOne(
-            {"id": habit_id, "user_id": user["id"]},
-            {"$set": {"order": index}}
-        )
-        for index, habit_id in enumerate(data.habit_ids)
+# ============ SEARCH ROUTES ============
+
+SEARCH_SNIPPET_CHARS = 160
+SEARCH_SOURCES = {
+    # kind -> (collection name, field the snippet is cut from)
+    "note": ("notes", "content_text"),
+    "task": ("tasks", "description"),
+}
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def make_snippet(text: str, query: str, width: int = SEARCH_SNIPPET_CHARS) -> str:
+    """Cut a window of plain text around the first query term found in `text`.
+
+    Task descriptions may hold editor HTML, so tags are stripped first. Text
+    search matches on stems, so when no term appears verbatim the snippet
+    falls back to the start of the text.
+    """
+    plain = html_to_text(text)
+    if len(plain) <= width:
+        return plain
+    lowered = plain.lower()
+    hits = [lowered.find(term) for term in _WORD_RE.findall(query.lower())]
+    hits = [pos for pos in hits if pos >= 0]
+    start = max(0, min(hits) - width // 4) if hits else 0
+    end = min(len(plain), start + width)
+    start = max(0, end - width)
+    snippet = plain[start:end]
+    if start > 0:
+        snippet = "…" + snippet
+    if end < len(plain):
+        snippet += "…"
+    return snippet
+
+def _search_after(kind: str, position: Optional[dict]) -> Optional[dict]:
+    """Keyset condition for results ranked by (score desc, kind asc, id asc)."""
+    if position is None:
+        return None
+    score = position["score"]
+    if kind < position["kind"]:
+        return {"score": {"$lt": score}}
+    if kind > position["kind"]:
+        return {"score": {"$lte": score}}
+    return {"$or": [
+        {"score": {"$lt": score}},
+        {"score": score, "id": {"$gt": position["id"]}},
+    ]}
+
+async def _search_collection(kind: str, user_id: str, q: str, position: Optional[dict], limit: int) -> list:
+    collection_name, body_field = SEARCH_SOURCES[kind]
+    pipeline = [
+        {"$match": {"user_id": user_id, "$text": {"$search": q}}},
+        {"$addFields": {"score": {"$meta": "textScore"}}},
     ]
-    await db.habits.bulk_write(operations)
-    return {"message": "Habits reordered"}
+    after = _search_after(kind, position)
+    if after:
+        pipeline.append({"$match": after})
+    pipeline += [
+        {"$sort": {"score": -1, "id": 1}},
+        {"$limit": limit},
+        {"$project": {
+            "_id": 0, "id": 1, "title": 1, "tags": 1, "status": 1, "parent_id": 1,
+            "updated_at": 1, "score": 1, body_field: 1,
+        }},
+    ]
+    docs = await db[collection_name].aggregate(pipeline).to_list(limit)
+    for doc in docs:
+        doc["kind"] = kind
+        doc["snippet"] = make_snippet(doc.pop(body_field, ""), q)
+        doc["tags"] = doc.get("tags") or []
+    return docs
+
+@api_router.get("/search", response_model=List[SearchResult])
+async def search(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    kind: Optional[Literal["note", "task"]] = None,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+):
+    """Ranked full-text search over note titles/content/tags and task titles/descriptions/tags.
+
+    Each collection is queried through its per-user text index and the two
+    ranked lists are merged; X-Next-Cursor carries the (score, kind, id) of
+    the last result.
+    """
+    position = None
+    if cursor:
+        position = decode_cursor(cursor)
+        if not isinstance(position.get("score"), (int, float)) or position.get("kind") not in SEARCH_SOURCES \
+                or not isinstance(position.get("id"), str):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    kinds = [kind] if kind else list(SEARCH_SOURCES)
+    if "note" in kinds:
+        await ensure_note_text(user["id"])
+    ranked = await asyncio.gather(*[
+        _search_collection(k, user["id"], q, position, limit + 1) for k in kinds
+    ])
+    results = sorted(
+        (doc for docs in ranked for doc in docs),
+        key=lambda doc: (-doc["score"], doc["kind"], doc["id"]),
+    )
+    if len(results) > limit:
+        results = results[:limit]
+        last = results[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor({"score": last["score"], "kind": last["kind"], "id": last["id"]})
+    return results
+
+# ============ BATCH ROUTES ============
+
+BATCH_MAX_OPERATIONS = 500
+BATCH_MODELS = {
+    "tasks": (TaskCreate, TaskUpdate),
+    "notes": (NoteCreate, NoteUpdate),
+    "habits": (HabitCreate, HabitUpdate),
+    "budget_rows": (BudgetRowCreate, BudgetRowUpdate),
+}
+# Created documents are returned in the same shape as the single-item routes
+# (budget rows have no response model there either)
+BATCH_RESPONSE_MODELS = {"tasks": TaskResponse, "notes": NoteResponse, "habits": HabitResponse}
+# Changes to these fields award XP, update streaks or rewrite a note subtree,
+# so they stay on the single-item routes
+BATCH_LOCKED_FIELDS = {"tasks": {"status", "checklist"}, "habits": {"is_completed"}, "notes": {"parent_id"}}
+
+def _batch_error(index: int, message: str) -> dict:
+    return {"index": index, "status": "error", "error": message}
+
+async def _bulk_execute(collection, planned: list, results: list) -> set:
+    """Run planned (index, write, id, document) entries as one unordered bulk_write.
+
+    Fills in `results` for every entry and returns the batch indexes that succeeded.
+    """
+    if not planned:
+        return set()
+    failed = {}
+    try:
+        await collection.bulk_write([write for _, write, _, _ in planned], ordered=False)
+    except BulkWriteError as e:
+        failed = {err["index"]: err.get("errmsg", "Write failed") for err in e.details.get("writeErrors", [])}
+    succeeded = set()
+    for position, (index, _, doc_id, document) in enumerate(planned):
+        if position in failed:
+            results[index] = _batch_error(index, failed[position])
+            continue
+        results[index] = {"index": index, "status": "ok", "id": doc_id}
+        if document is not None:
+            document.pop("_id", None)
+            results[index]["document"] = document
+        succeeded.add(index)
+    return succeeded
+
+def _row_amounts(row: dict) -> dict:
+    return {field: row.get(field) for field in ("credit", "debit")}
+
+async def _guarded_execute(collection, guarded: list, results: list) -> set:
+    """Run (index, filter, update, id) writes one by one; update None means delete.
+
+    Used where the filter pins values read earlier in the batch, so each
+    write needs its own matched count to tell whether they still held.
+    """
+    async def run(index, query, update, doc_id):
+        if update is None:
+            applied = (await collection.delete_one(query)).deleted_count
+        else:
+            applied = (await collection.update_one(query, update)).matched_count
+        if not applied:
+            results[index] = _batch_error(index, "Changed since it was read; retry")
+            return None
+        results[index] = {"index": index, "status": "ok", "id": doc_id}
+        return index
+
+    done = await asyncio.gather(*(run(*entry) for entry in guarded))
+    return {index for index in done if index is not None}
+
+async def _run_batch_collection(name: str, entries: list, user_id: str, now: str, seq: int, results: list):
+    collection = db[name]
+    owner = {"user_id": user_id}
+
+    target_ids = [op.id for _, op, _ in entries if op.op != "create"]
+    owned = {}
+    if target_ids:
+        async for doc in collection.find(
+            {"id": {"$in": target_ids}, **owner},
+            {"_id": 0, "id": 1, "sheet_id": 1, "credit": 1, "debit": 1, "parent_id": 1},
+        ):
+            owned[doc["id"]] = doc
+
+    creates = [(index, payload) for index, op, payload in entries if op.op == "create"]
+    sheet_of = {index: op.sheet_id for index, op, _ in entries}
+    orders = {}
+    if name == "habits":
+        unordered = [index for index, payload in creates if payload.order is None]
+        if unordered:
+            first = await allocate_habit_orders(user_id, len(unordered))
+            orders = {index: first + offset for offset, index in enumerate(unordered)}
+    elif name == "budget_rows":
+        by_sheet = {}
+        for index, payload in creates:
+            by_sheet.setdefault(sheet_of[index], []).append((index, payload))
+        for sheet_id, sheet_creates in by_sheet.items():
+            sheet = await reserve_sheet_rows(
+                sheet_id, user_id, len(sheet_creates),
+                credit=sum(payload.credit for _, payload in sheet_creates),
+                debit=sum(payload.debit for _, payload in sheet_creates),
+                seq=seq,
+            )
+            if not sheet:
+                for index, _ in sheet_creates:
+                    results[index] = _batch_error(index, "Sheet not found")
+                continue
+            first = sheet["last_order"] - len(sheet_creates) + 1
+            orders.update({index: first + offset for offset, (index, _) in enumerate(sheet_creates)})
+
+    planned = []
+    # Row writes whose sheet-total deltas come from `owned` only apply if the
+    # amounts are still the ones read above
+    guarded = []
+    tree_deletes = []
+    paths = {}
+    if name == "notes":
+        parent_ids = list({payload.parent_id for _, payload in creates if payload.parent_id})
+        if parent_ids:
+            await ensure_note_ancestors(user_id)
+            async for parent in db.notes.find(
+                {"id": {"$in": parent_ids}, **owner}, {"_id": 0, "id": 1, "ancestors": 1}
+            ):
+                paths[parent["id"]] = parent.get("ancestors", []) + [parent["id"]]
+        note_deletes = [op.id for _, op, _ in entries if op.op == "delete" and op.id in owned]
+        if note_deletes:
+            parents = set(await db.notes.distinct("parent_id", {"parent_id": {"$in": note_deletes}, **owner}))
+            tree_deletes = [(index, op.id) for index, op, _ in entries if op.op == "delete" and op.id in parents]
+
+    for index, op, payload in entries:
+        if results[index] is not None:
+            continue
+        if op.op == "create":
+            if name == "tasks":
+                document = build_task_doc(user_id, payload, now)
+            elif name == "notes":
+                if payload.parent_id is not None and payload.parent_id not in paths:
+                    results[index] = _batch_error(index, "Parent note not found")
+                    continue
+                document = build_note_doc(user_id, payload, now, paths.get(payload.parent_id, []))
+            elif name == "habits":
+                document = build_habit_doc(user_id, payload, orders.get(index, payload.order), now)
+            else:
+                document = build_row_doc(user_id, sheet_of[index], payload, orders[index], now)
+            document["sync_seq"] = seq
+            planned.append((index, InsertOne(document), document["id"], document))
+        elif op.id not in owned:
+            results[index] = _batch_error(index, "Not found")
+        elif op.op == "update":
+            if name in ("tasks", "notes"):
+                payload["updated_at"] = now
+            if payload:
+                payload["sync_seq"] = seq
+                update = {"$set": payload}
+                if name == "notes" and "content" in payload:
+                    update["$inc"] = {"revision": 1}
+                    payload["content_text"] = html_to_text(payload["content"])
+                if name == "budget_rows" and ("credit" in payload or "debit" in payload):
+                    guarded.append((index, {"id": op.id, **owner, **_row_amounts(owned[op.id])}, update, op.id))
+                else:
+                    planned.append((index, UpdateOne({"id": op.id, **owner}, update), op.id, None))
+            else:
+                results[index] = {"index": index, "status": "ok", "id": op.id}
+        elif name == "budget_rows":
+            guarded.append((index, {"id": op.id, **owner, **_row_amounts(owned[op.id])}, None, op.id))
+        elif (index, op.id) not in tree_deletes:
+            planned.append((index, DeleteOne({"id": op.id, **owner}), op.id, None))
+
+    succeeded = await _bulk_execute(collection, planned, results)
+    response_model = BATCH_RESPONSE_MODELS.get(name)
+    for index in succeeded:
+        document = results[index].get("document")
+        if document is not None and response_model is not None:
+            if name == "notes":
+                normalize_note(document)
+            results[index]["document"] = response_model(**document).model_dump()
+    succeeded |= await _guarded_execute(collection, guarded, results)
+
+    # Deleting a note with children re-parents them, which is a per-note tree operation
+    for index, note_id in tree_deletes:
+        await remove_note(user_id, owned[note_id], seq)
+        results[index] = {"index": index, "status": "ok", "id": note_id}
+        succeeded.add(index)
+
+    # Explicit orders move the allocators past them, as on the single-item routes
+    if name == "habits":
+        explicit = []
+        for index, op, payload in entries:
+            if index in succeeded and op.op != "delete":
+                order = payload.order if op.op == "create" else payload.get("order")
+                if order is not None:
+                    explicit.append(order)
+        if explicit:
+            await raise_sequence_floor("habits", user_id, max(explicit) + 1)
+    elif name == "budget_rows":
+        highest = {}
+        for index, op, payload in entries:
+            if index in succeeded and op.op == "update" and "order" in payload:
+                sheet_id = owned[op.id]["sheet_id"]
+                highest[sheet_id] = max(highest.get(sheet_id, payload["order"]), payload["order"])
+        for sheet_id, order in highest.items():
+            await raise_last_row_order(sheet_id, user_id, order)
+
+    tree_deleted = {note_id for _, note_id in tree_deletes}
+    await record_deletions(user_id, name, [
+        op.id for index, op, _ in entries
+        if index in succeeded and op.op == "delete" and op.id not in tree_deleted
+    ], seq)
+
+    done = [(op, payload) for index, op, payload in entries if index in succeeded]
+    created = sum(1 for op, _ in done if op.op == "create")
+    deleted = sum(1 for op, _ in done if op.op == "delete")
+    if name == "tasks" and created:
+        await side_effects.enqueue(user_id, xp=5 * created)
+    elif name == "notes" and (created or deleted):
+        await side_effects.enqueue(
+            user_id,
+            xp=5 * created,
+            activity={"notes_created": created} if created else None,
+            stats={"notes_total": created - deleted},
+            achievements=bool(created),
+        )
+    elif name == "budget_rows":
+        deltas = {}
+        for index, op, payload in entries:
+            if op.op == "create":
+                if index in succeeded or index not in orders:
+                    continue
+                # Reserved up front but the insert failed: give the amounts back
+                sheet_id, sign, amounts, rows = sheet_of[index], -1, payload.model_dump(), -1
+            elif index not in succeeded:
+                continue
+            elif op.op == "update":
+                before = owned[op.id]
+                sheet_id, sign, rows = before["sheet_id"], 1, 0
+                amounts = {
+                    field: payload.get(field, before.get(field, 0)) - before.get(field, 0)
+                    for field in ("credit", "debit")
+                }
+            else:
+                before = owned[op.id]
+                sheet_id, sign, amounts, rows = before["sheet_id"], -1, before, -1
+            sheet_delta = deltas.setdefault(sheet_id, {"row_count": 0, "total_credit": 0, "total_debit": 0})
+            sheet_delta["row_count"] += rows
+            sheet_delta["total_credit"] += sign * amounts.get("credit", 0)
+            sheet_delta["total_debit"] += sign * amounts.get("debit", 0)
+        for sheet_id, sheet_delta in deltas.items():
+            await adjust_sheet_totals(sheet_id, user_id, seq=seq, **sheet_delta)
+
+@api_router.post("/batch")
+async def run_batch(data: BatchRequest, user: dict = Depends(get_current_user)):
+    """Apply create/update/delete operations across tasks, notes, habits and budget rows.
+
+    Payloads are validated with the same models as the single-item routes and
+    written as one unordered bulk_write per collection, so operations in a
+    batch must not depend on each other. Each operation gets its own result.
+    """
+    if len(data.operations) > BATCH_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_OPERATIONS} operations per batch")
+
+    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
+    results: list = [None] * len(data.operations)
+    grouped = {name: [] for name in BATCH_MODELS}
+
+    for index, op in enumerate(data.operations):
+        create_model, update_model = BATCH_MODELS[op.collection]
+        if op.op != "create" and not op.id:
+            results[index] = _batch_error(index, "id is required")
+            continue
+        if op.op == "create" and op.collection == "budget_rows" and not op.sheet_id:
+            results[index] = _batch_error(index, "sheet_id is required to create budget rows")
+            continue
+        try:
+            if op.op == "create":
+                payload = create_model(**op.data)
+            elif op.op == "update":
+                payload = update_model(**op.data).model_dump()
+                payload = {k: v for k, v in payload.items() if v is not None}
+            else:
+                payload = None
+        except ValidationError as e:
+            results[index] = _batch_error(index, "; ".join(
+                f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors()
+            ))
+            continue
+        if op.op == "update":
+            locked = BATCH_LOCKED_FIELDS.get(op.collection, set()) & payload.keys()
+            if locked:
+                results[index] = _batch_error(index, f"{', '.join(sorted(locked))} can't be changed in a batch")
+                continue
+            if "base_revision" in payload:
+                results[index] = _batch_error(index, "base_revision is only checked by PUT /api/notes/{id}")
+                continue
+        grouped[op.collection].append((index, op, payload))
+
+    touched = {name for name, entries in grouped.items() if entries}
+    if "budget_rows" in touched:
+        touched.add("budget_sheets")  # Row writes move their sheet's totals
+    seq = next_change_seq()
+    await asyncio.gather(*(
+        _run_batch_collection(name, entries, user["id"], now, seq, results)
+        for name, entries in grouped.items() if entries
+    ))
+    if touched:
+        side_effects.queue_version_bump(user["id"], *sorted(touched))
+    return {
+        "results": results,
+        "succeeded": sum(1 for r in results if r["status"] == "ok"),
+        "failed": sum(1 for r in results if r["status"] == "error"),
+    }
 
 # ============ DASHBOARD ROUTES ============
 
 @api_router.get("/dashboard/stats", response_model=DashboardStats)
 async def get_dashboard_stats(user: dict = Depends(get_current_user)):
-    user_id = user["id"]
-    user_data, notes_count, activity_totals, focus_summary = await asyncio.gather(
-        db.users.find_one({"id": user_id}, {"_id": 0}),
-        db.notes.count_documents({"user_id": user_id}),
-        get_activity_totals(user_id),
-        get_focus_summary(user_id),
-    )
+    """Streak/XP from the (cached) user principal, totals from the user_stats counters.
+
+    Both are kept current by the write paths, so a warm load does no queries.
+    """
+    stats = await get_user_stats(user["id"])
 
     return DashboardStats(
-        current_streak=user_data.get("current_streak", 0),
-        longest_streak=user_data.get("longest_streak", 0),
-        total_xp=user_data.get("total_xp", 0),
-        current_level=user_data.get("current_level", 1),
-        notes_count=notes_count,
-        total_tasks_completed=activity_totals.get("tasks_completed", 0),
-        total_focus_time=focus_summary.get("total_focus_time", 0),
+        current_streak=user.get("current_streak", 0),
+        longest_streak=user.get("longest_streak", 0),
+        total_xp=user.get("total_xp", 0),
+        current_level=user.get("current_level", 1),
+        notes_count=stats.get("notes_total", 0),
+        total_tasks_completed=stats.get("tasks_completed_total", 0),
+        total_focus_time=stats.get("focus_minutes_total", 0),
     )
 
 @api_router.get("/dashboard/activity", response_model=List[DailyActivityResponse])
-async def get_activity_data(days: int = 365, user: dict = Depends(get_current_user)):
+async def get_activity_data(
+    days: int = 365,
+    granularity: Literal["day", "week", "month", "year"] = "day",
+    user: dict = Depends(get_current_user),
+):
     start_date = (datetime.now(ZoneInfo("Asia/Kolkata")) - timedelta(days=days)).strftime("%Y-%m-%d")
     
-    activities = await db.daily_activity.find(
-        {"user_id": user["id"], "date": {"$gte": start_date}},
-        {"_id": 0}
-    ).sort("date", 1).to_list(days)
-    
-    return activities
+    if granularity == "day":
+        activities = await db.daily_activity.find(
+            {"user_id": user["id"], "date": {"$gte": start_date}},
+            {"_id": 0}
+        ).sort("date", 1).to_list(days + 1)
+        return activities
+
+    # Include the bucket the range starts in, not just buckets that start inside it
+    first_bucket = next(start for g, _, start in activity_periods(start_date) if g == granularity)
+    query = {"user_id": user["id"], "granularity": granularity, "date": {"$gte": first_bucket}}
+    if not await db.activity_rollups.find_one({"user_id": user["id"], "granularity": "lifetime"}, {"_id": 1}):
+        await rebuild_activity_rollups(user["id"])
+    return await db.activity_rollups.find(query, {"_id": 0}).sort("date", 1).to_list(None)
+def _sync_cursor(seq: int) -> str:
+    return encode_cursor({"seq": seq, "at": int(time.time())})
+
 @api_router.get("/preload")
-async def preload_data(since: Optional[str] = None, user: dict = Depends(get_current_user)):
-    """Fetch core data in a single round-trip to reduce initial load latency."""
+async def preload_data(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    since: Optional[str] = None,
+    user: dict = Depends(get_current_user),
+):
+    """Fetch core data in a single round-trip to reduce initial load latency.
+
+    Without a cursor this is a full load of tasks, notes (without content),
+    budget sheets and habits; budget rows are still loaded per sheet. Passing
+    the returned `cursor` back makes it a delta: every synced collection,
+    rows included, returns only documents written since, and `deleted` lists
+    the ids removed since, per collection. The delta window reaches back
+    SYNC_CURSOR_OVERLAP_SECONDS before the cursor to cover writes that were in
+    flight when it was issued and clock skew between workers, so clients
+    must apply it idempotently. A cursor older
+    than the tombstone retention gets a full load with `full: true`.
+
+    `since` (an updated_at timestamp) is the older, deletion-blind protocol
+    and is kept for clients that haven't moved to cursors.
+
+    Responses carry an ETag, so a client polling with an unchanged cursor
+    gets a 304 while nothing has been written.
+    """
     uid = user["id"]
+    midnight = datetime.now(ZoneInfo("Asia/Kolkata")).replace(hour=0, minute=0, second=0, microsecond=0)
+    unchanged = await not_modified(request, response, uid, SYNC_COLLECTIONS, valid_from=midnight)
+    if unchanged:
+        return unchanged
+    floor = None
+    if cursor:
+        position = decode_cursor(cursor)
+        if not isinstance(position.get("seq"), int) or not isinstance(position.get("at"), int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if time.time() - position["at"] < SYNC_TOMBSTONE_TTL_DAYS * 86400:
+            floor = max(0, position["seq"] - SYNC_CURSOR_OVERLAP_SECONDS * 1_000_000)
+    delta = floor is not None
+
+    # Take the high-water mark before reading: anything stamped after it is
+    # either in this response or after the next cursor
+    high_water = next_change_seq()
+    today = midnight.strftime("%Y-%m-%d")
+
+    def changed(query: dict) -> dict:
+        return {**query, "sync_seq": {"$gt": floor}} if delta else query
 
     async def _tasks():
         query = {"user_id": uid}
-        if since:
+        if since and not delta:
             query["updated_at"] = {"$gte": since}
-        return await db.tasks.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+        return await db.tasks.find(changed(query), {"_id": 0}).sort("created_at", -1).to_list(None if delta else 1000)
 
     async def _notes():
         query = {"user_id": uid}
-        if since:
+        if since and not delta:
             query["updated_at"] = {"$gte": since}
         notes = await db.notes.find(
-            query,
-            {"_id": 0, "content": 0}  # Exclude heavy content field for speed
-        ).sort("updated_at", -1).to_list(1000)
-        for n in notes:
-            if "categories" not in n:
-                n["categories"] = [n.pop("category", "general")] if isinstance(n.get("category"), str) else n.get("category", ["general"])
-        return notes
+            changed(query),
+            {"_id": 0, "content": 0, "content_text": 0}  # Exclude heavy content fields for speed
+        ).sort("updated_at", -1).to_list(None if delta else 1000)
+        return [normalize_note(n) for n in notes]
 
     async def _sheets():
         query = {"user_id": uid}
-        if since:
-            # Budget sheets only track created_at currently
+        if since and not delta:
+            # Budget sheets only track created_at in the legacy protocol
             query["created_at"] = {"$gte": since}
-        return await db.budget_sheets.find(query, {"_id": 0}).sort("order", 1).to_list(100)
-
-    tasks, notes, sheets = await asyncio.gather(_tasks(), _notes(), _sheets())
+        return await db.budget_sheets.find(changed(query), {"_id": 0}).sort("order", 1).to_list(None if delta else 100)
+
+    async def _habits():
+        habits = await db.habits.find(changed({"user_id": uid}), {"_id": 0}).sort("order", 1).to_list(None if delta else 100)
+        return [apply_effective_completion(habit, today) for habit in habits]
+
+    async def _rows():
+        if not delta:
+            return []
+        return await db.budget_rows.find(changed({"user_id": uid}), {"_id": 0}).sort(
+            [("sheet_id", 1), ("order", 1)]
+        ).to_list(None)
+
+    async def _deleted():
+        deleted = {name: [] for name in SYNC_COLLECTIONS}
+        if delta:
+            async for tombstone in db.sync_tombstones.find(
+                {"user_id": uid, "sync_seq": {"$gt": floor}}, {"_id": 0, "collection": 1, "id": 1}
+            ):
+                deleted.setdefault(tombstone["collection"], []).append(tombstone["id"])
+        return deleted
+
+    tasks, notes, sheets, habits, rows, deleted = await asyncio.gather(
+        _tasks(), _notes(), _sheets(), _habits(), _rows(), _deleted()
+    )
 
-    return {
+    return send_documents({
         "tasks": tasks,
         "notes": notes,
         "budget_sheets": sheets,
+        "habits": habits,
+        "budget_rows": rows,
+        "deleted": deleted,
+        "full": not delta and not since,
+        "cursor": _sync_cursor(high_water),
         "server_time": datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-    }
+    }, response)
 
 @api_router.get("/")
 async def root():
@@ -1415,94 +3707,79 @@ ACHIEVEMENTS = [
     {"id": "note_taker", "name": "Note Taker", "description": "Create 50 notes", "type": "notes", "requirement": 50, "xp_reward": 200, "badge_icon": "file-text"},
 ]
 
+def is_achievement_met(ach: dict, user_data: dict, stats: dict) -> bool:
+    """Compare an achievement threshold against the user's running counters."""
+    if ach["type"] == "task":
+        return stats.get("tasks_completed_total", 0) >= ach["requirement"]
+    if ach["type"] == "streak":
+        return user_data.get("longest_streak", 0) >= ach["requirement"]
+    if ach["type"] == "focus":
+        return stats.get("focus_sessions_total", 0) >= ach["requirement"]
+    if ach["type"] == "focus_hours":
+        return stats.get("focus_minutes_total", 0) >= ach["requirement"]
+    if ach["type"] == "notes":
+        return stats.get("notes_total", 0) >= ach["requirement"]
+    return False
+
 # Helper to check and unlock achievements for user
 async def check_achievements(user_id: str):
-    user_data, activity_totals, focus_summary, notes_count, user_achievements = await asyncio.gather(
-        db.users.find_one({"id": user_id}, {"_id": 0}),
-        get_activity_totals(user_id),
-        get_focus_summary(user_id),
-        db.notes.count_documents({"user_id": user_id}),
-        db.user_achievements.find({"user_id": user_id}, {"_id": 0}).to_list(100),
+    """Unlock every achievement the user now qualifies for in one insert_many and one XP award."""
+    user_data, stats, user_achievements = await asyncio.gather(
+        db.users.find_one({"id": user_id}, {"_id": 0, "longest_streak": 1}),
+        get_user_stats(user_id),
+        db.user_achievements.find({"user_id": user_id}, {"_id": 0, "achievement_id": 1}).to_list(100),
     )
     if not user_data:
         return
 
-    tasks_completed = activity_totals.get("tasks_completed", 0)
-    focus_sessions = focus_summary.get("total_sessions", 0)
-    current_streak = user_data.get("longest_streak", 0)
-    total_focus_minutes = focus_summary.get("total_focus_time", 0)
-
     unlocked_ids = {ua["achievement_id"] for ua in user_achievements}
-    
-    for ach in ACHIEVEMENTS:
-        if ach["id"] in unlocked_ids:
-            continue
-        unlocked = False
-        if ach["type"] == "task":
-            unlocked = tasks_completed >= ach["requirement"]
-        elif ach["type"] == "streak":
-            unlocked = current_streak >= ach["requirement"]
-        elif ach["type"] == "focus":
-            unlocked = focus_sessions >= ach["requirement"]
-        elif ach["type"] == "focus_hours":
-            unlocked = total_focus_minutes >= ach["requirement"]
-        elif ach["type"] == "notes":
-            unlocked = notes_count >= ach["requirement"]
-        
-        if unlocked:
-            now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-            await db.user_achievements.insert_one({
-                "id": str(uuid.uuid4()),
-                "user_id": user_id,
-                "achievement_id": ach["id"],
-                "unlocked_at": now
-            })
-            await add_xp(user_id, ach["xp_reward"])
+    newly_met = [
+        ach for ach in ACHIEVEMENTS
+        if ach["id"] not in unlocked_ids and is_achievement_met(ach, user_data, stats)
+    ]
+    if not newly_met:
+        return
+
+    now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
+    duplicates = set()
+    try:
+        await db.user_achievements.insert_many([
+            {"id": str(uuid.uuid4()), "user_id": user_id, "achievement_id": ach["id"], "unlocked_at": now}
+            for ach in newly_met
+        ], ordered=False)
+    except BulkWriteError as e:
+        # Duplicates were unlocked concurrently elsewhere and already awarded
+        duplicates = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") == 11000}
+        if len(duplicates) < len(e.details.get("writeErrors", [])):
+            raise
+    xp = sum(ach["xp_reward"] for index, ach in enumerate(newly_met) if index not in duplicates)
+    if xp:
+        await add_xp(user_id, xp)
 
 @api_router.get("/achievements", response_model=List[AchievementResponse])
-async def get_achievements(user: dict = Depends(get_current_user)):
+async def get_achievements(request: Request, response: Response, user: dict = Depends(get_current_user)):
+    """Unlock state from user_achievements plus the cached counters; no writes.
+
+    Achievements whose thresholds are met but haven't been recorded yet (e.g.
+    counters that were just reconciled) show as unlocked without a date, and
+    the actual unlock and XP award are queued for the side-effect worker.
+    """
     user_id = user["id"]
-    activity_totals, focus_summary, notes_count, user_data, user_achievements = await asyncio.gather(
-        get_activity_totals(user_id),
-        get_focus_summary(user_id),
-        db.notes.count_documents({"user_id": user_id}),
-        db.users.find_one({"id": user_id}, {"_id": 0}),
-        db.user_achievements.find({"user_id": user_id}, {"_id": 0}).to_list(100),
+    unchanged = await not_modified(request, response, user_id, ("achievements",))
+    if unchanged:
+        return unchanged
+    stats, user_achievements = await asyncio.gather(
+        get_user_stats(user_id),
+        db.user_achievements.find({"user_id": user_id}, {"_id": 0, "achievement_id": 1, "unlocked_at": 1}).to_list(100),
     )
-
-    tasks_completed = activity_totals.get("tasks_completed", 0)
-    current_streak = user_data.get("longest_streak", 0)
-    focus_sessions = focus_summary.get("total_sessions", 0)
-    total_focus_minutes = focus_summary.get("total_focus_time", 0)
-
     unlocked_ids = {ua["achievement_id"]: ua["unlocked_at"] for ua in user_achievements}
-    
+
     result = []
+    catch_up = False
     for ach in ACHIEVEMENTS:
-        unlocked = False
-        if ach["type"] == "task":
-            unlocked = tasks_completed >= ach["requirement"]
-        elif ach["type"] == "streak":
-            unlocked = current_streak >= ach["requirement"]
-        elif ach["type"] == "focus":
-            unlocked = focus_sessions >= ach["requirement"]
-        elif ach["type"] == "focus_hours":
-            unlocked = total_focus_minutes >= ach["requirement"]
-        elif ach["type"] == "notes":
-            unlocked = notes_count >= ach["requirement"]
-        
-        # Check if already in db and if not, add it
-        if unlocked and ach["id"] not in unlocked_ids:
-            now = datetime.now(ZoneInfo("Asia/Kolkata")).isoformat()
-            await db.user_achievements.insert_one({
-                "id": str(uuid.uuid4()),
-                "user_id": user_id,
-                "achievement_id": ach["id"],
-                "unlocked_at": now
-            })
-            await add_xp(user_id, ach["xp_reward"])
-            unlocked_ids[ach["id"]] = now
-        
+        unlocked = ach["id"] in unlocked_ids
+        if not unlocked and is_achievement_met(ach, user, stats):
+            unlocked = catch_up = True
         result.append(AchievementResponse(
             id=ach["id"],
             name=ach["name"],
@@ -1511,19 +3788,54 @@ async def get_achievements(user: dict = Depends(get_current_user)):
             requirement=ach["requirement"],
             xp_reward=ach["xp_reward"],
             badge_icon=ach["badge_icon"],
-            unlocked=ach["id"] in unlocked_ids,
+            unlocked=unlocked,
             unlocked_at=unlocked_ids.get(ach["id"])
         ))
-    
+
+    if catch_up:
+        side_effects.queue_achievement_check(user_id)
     return result
 
+@api_router.post("/stats/reconcile")
+@limiter.limit("5/minute")
+async def reconcile_stats(request: Request, user: dict = Depends(get_current_user)):
+    """Rebuild the caller's running counters from source collections."""
+    await rebuild_activity_rollups(user["id"])
+    stats = await reconcile_user_stats(user["id"])
+    await check_achievements(user["id"])
+    await bump_versions(user["id"], "achievements")
+    return stats
+
+# Payloads that are compressed already; gzipping them again only costs CPU
+PRECOMPRESSED_MEDIA_TYPES = ("application/gzip", EXPORT_FORMATS["xlsx"][0], EXPORT_FORMATS["parquet"][0])
+
+class _PassPrecompressedResponder(GZipResponder):
+    async def send_with_gzip(self, message):
+        await super().send_with_gzip(message)
+        if message["type"] == "http.response.start":
+            media_type = Headers(raw=message["headers"]).get("content-type", "").split(";")[0].strip()
+            # Sent through untouched, as if it already had a Content-Encoding
+            self.content_encoding_set = self.content_encoding_set or media_type in PRECOMPRESSED_MEDIA_TYPES
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that leaves already-compressed downloads alone."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = _PassPrecompressedResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
 # Add middleware
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=GZIP_COMPRESS_LEVEL)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=[origin.strip() for origin in os.environ.get('CORS_ORIGINS', '').split(',') if origin.strip()],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified"],
 )
 
 # Include router
@@ -1532,6 +3844,7 @@ app.include_router(api_router)
 @app.on_event("startup")
 async def startup_db_client():
     """Initialize DB connection and ensure indexes on startup."""
+    side_effects.start()
     try:
         await client.admin.command("ping")
         logger.info(f"✅ Successfully connected to MongoDB database: '{os.environ['DB_NAME']}'")
@@ -1549,14 +3862,31 @@ async def startup_db_client():
         await db.tasks.create_index([("user_id", 1), ("is_pinned", -1), ("created_at", -1)])
         await db.tasks.create_index([("user_id", 1), ("updated_at", -1)])
         await db.tasks.create_index("user_id")
+        await db.tasks.create_index([("user_id", 1), ("created_at", -1), ("id", -1)])
+        await db.tasks.create_index(
+            [("user_id", 1), ("title", "text"), ("description", "text"), ("tags", "text")],
+            weights={"title": 10, "tags": 5, "description": 1},
+            name="tasks_search",
+        )
 
         # Note indexes
         await db.notes.create_index("id", unique=True)
         await db.notes.create_index("user_id")
         await db.notes.create_index([("user_id", 1), ("created_at", -1)])
         await db.notes.create_index([("user_id", 1), ("parent_id", 1)])
+        await db.notes.create_index([("user_id", 1), ("ancestors", 1)])
         await db.notes.create_index([("user_id", 1), ("is_favorite", -1)])
         await db.notes.create_index([("user_id", 1), ("updated_at", -1)])
+        await db.notes.create_index([("user_id", 1), ("updated_at", -1), ("id", -1)])
+        search_index = (await db.notes.index_information()).get("notes_search")
+        if search_index and "content_text" not in search_index.get("weights", {}):
+            # The first version indexed the raw editor HTML
+            await db.notes.drop_index("notes_search")
+        await db.notes.create_index(
+            [("user_id", 1), ("title", "text"), ("content_text", "text"), ("tags", "text")],
+            weights={"title": 10, "tags": 5, "content_text": 1},
+            name="notes_search",
+        )
 
         # Budget indexes
         await db.budget_sheets.create_index("id", unique=True)
@@ -1566,26 +3896,44 @@ async def startup_db_client():
         await db.budget_rows.create_index("id", unique=True)
         await db.budget_rows.create_index([("sheet_id", 1), ("user_id", 1)])
         await db.budget_rows.create_index([("sheet_id", 1), ("user_id", 1), ("order", 1)])
+        await db.budget_rows.create_index([("sheet_id", 1), ("user_id", 1), ("order", 1), ("id", 1)])
 
         # Focus & habits indexes
         await db.focus_sessions.create_index("id", unique=True)
         await db.focus_sessions.create_index([("user_id", 1), ("completed_at", -1)])
         await db.focus_sessions.create_index([("user_id", 1), ("interrupted", 1), ("completed_at", -1)])
         await db.focus_sessions.create_index([("user_id", 1), ("started_at", -1)])
+        await db.focus_sessions.create_index([("user_id", 1), ("started_at", -1), ("id", -1)])
         await db.habits.create_index("id", unique=True)
         await db.habits.create_index([("user_id", 1), ("order", 1)])
 
         # Activity & achievements indexes
         await db.daily_activity.create_index([("user_id", 1), ("date", -1)], unique=True)
+        await db.activity_rollups.create_index([("user_id", 1), ("granularity", 1), ("period", 1)], unique=True)
+        await db.activity_rollups.create_index([("user_id", 1), ("granularity", 1), ("date", 1)])
         await db.user_achievements.create_index([("user_id", 1), ("achievement_id", 1)], unique=True)
+        await db.user_stats.create_index("user_id", unique=True)
+        await db.sequences.create_index("owner_id")
+
+        # Delta sync indexes
+        for name in SYNC_COLLECTIONS:
+            await db[name].create_index([("user_id", 1), ("sync_seq", 1)])
+        await db.sync_tombstones.create_index([("user_id", 1), ("sync_seq", 1)])
+        await db.sync_tombstones.create_index("deleted_at", expireAfterSeconds=SYNC_TOMBSTONE_TTL_DAYS * 86400)
+        if SIDE_EFFECT_OUTBOX:
+            await db.side_effect_outbox.create_index("id", unique=True)
+            await db.side_effect_outbox.create_index([("status", 1), ("updated_at", 1)])
         logger.info("✅ Database indexes ensured")
+        await side_effects.recover()
     except Exception as e:
         logger.error(f"❌ Failed to connect to MongoDB: {e}")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    """Close MongoDB connection on shutdown."""
+    """Flush pending side effects, then close the MongoDB connection."""
+    await side_effects.drain(SIDE_EFFECT_DRAIN_TIMEOUT)
     client.close()
+    password_hasher.shutdown()
     logger.info("🔌 MongoDB connection closed")
 
 # Startup for local development and production
@@ -11,6 +11,7 @@ export const DataCacheProvider = ({ children }) => {
   // Subscribers: page components register to get notified of cache updates for their key
   const subscribersRef = useRef(new Map()); // Map<key, Set<callback>>
 
+  // Opaque delta-sync cursor returned by /preload
   const lastSyncRef = useRef(null);
 
   // Helper to get local storage key
@@ -43,7 +44,7 @@ export const DataCacheProvider = ({ children }) => {
         const stored = localStorage.getItem(key);
         if (stored) {
           cacheRef.current = JSON.parse(stored);
-          lastSyncRef.current = localStorage.getItem(`${key}_sync`) || null;
+          lastSyncRef.current = localStorage.getItem(`${key}_cursor`) || null;
           // Notify components so they pick up cached data instantly
           Object.keys(cacheRef.current).forEach(k => notifyKey(k));
         }
@@ -111,13 +112,14 @@ export const DataCacheProvider = ({ children }) => {
     if (!api) return;
     try {
       const requestStartedAt = Date.now();
-      const isDeltaSync = !!lastSyncRef.current;
-      const url = isDeltaSync 
-        ? `/preload?since=${encodeURIComponent(lastSyncRef.current)}` 
+      const url = lastSyncRef.current
+        ? `/preload?cursor=${encodeURIComponent(lastSyncRef.current)}` 
         : '/preload';
         
       const res = await api.get(url);
-      const { tasks, notes, budget_sheets, server_time } = res.data;
+      const { tasks, notes, budget_sheets, deleted = {}, full, cursor } = res.data;
+      // The server falls back to a full load when the cursor has expired
+      const isDeltaSync = !full;
       const now = Date.now();
       
       const tasksModifiedDuringRequest = getCacheTimestamp('tasks') > requestStartedAt;
@@ -125,11 +127,12 @@ export const DataCacheProvider = ({ children }) => {
       const sheetsModifiedDuringRequest = getCacheTimestamp('budget_sheets') > requestStartedAt;
 
       if (isDeltaSync) {
-        // Delta sync: Merge new items into existing cache
-        const mergeArr = (oldArr = [], newArr = []) => {
-          if (!newArr || !newArr.length) return oldArr;
+        // Delta sync: Merge changed items into existing cache and drop deleted ones
+        const mergeArr = (oldArr = [], newArr = [], removedIds = []) => {
+          if ((!newArr || !newArr.length) && !removedIds.length) return oldArr;
           const map = new Map(oldArr.map(item => [item.id, item]));
-          newArr.forEach(item => map.set(item.id, item));
+          (newArr || []).forEach(item => map.set(item.id, item));
+          removedIds.forEach(id => map.delete(id));
           return Array.from(map.values());
         };
 
@@ -141,19 +144,19 @@ export const DataCacheProvider = ({ children }) => {
           ...cacheRef.current,
           ...(tasksModifiedDuringRequest ? {} : {
             tasks: {
-              data: mergeArr(existingTasks, tasks).sort((a,b) => new Date(b.created_at) - new Date(a.created_at)),
+              data: mergeArr(existingTasks, tasks, deleted.tasks).sort((a,b) => new Date(b.created_at) - new Date(a.created_at)),
               timestamp: now,
             },
           }),
           ...(notesModifiedDuringRequest ? {} : {
             notes: {
-              data: mergeArr(existingNotes, notes).sort((a,b) => new Date(b.updated_at) - new Date(a.updated_at)),
+              data: mergeArr(existingNotes, notes, deleted.notes).sort((a,b) => new Date(b.updated_at) - new Date(a.updated_at)),
               timestamp: now,
             },
           }),
           ...(sheetsModifiedDuringRequest ? {} : {
             budget_sheets: {
-              data: mergeArr(existingSheets, budget_sheets).sort((a,b) => a.order - b.order),
+              data: mergeArr(existingSheets, budget_sheets, deleted.budget_sheets).sort((a,b) => a.order - b.order),
               timestamp: now,
             },
           }),
@@ -173,8 +176,8 @@ export const DataCacheProvider = ({ children }) => {
         notesModifiedDuringRequest ||
         sheetsModifiedDuringRequest;
 
-      if (server_time && !hasConcurrentLocalWrites) {
-        lastSyncRef.current = server_time;
+      if (cursor && !hasConcurrentLocalWrites) {
+        lastSyncRef.current = cursor;
       }
       
       // Notify all prefetched keys
@@ -208,8 +211,8 @@ export const DataCacheProvider = ({ children }) => {
       if (storageKey) {
         try {
           localStorage.setItem(storageKey, JSON.stringify(cacheRef.current));
-          if (server_time && !hasConcurrentLocalWrites) {
-            localStorage.setItem(`${storageKey}_sync`, server_time);
+          if (cursor && !hasConcurrentLocalWrites) {
+            localStorage.setItem(`${storageKey}_cursor`, cursor);
           }
         } catch {
         }
@@ -32,6 +32,22 @@ import {
   Search, ChevronRight, ChevronDown, File, Upload, ArrowLeft, X
 } from 'lucide-react';
 
+// Single splice op turning `before` into `after` (common prefix/suffix trim).
+// Offsets are JS string indexes (UTF-16 units), which is what the API expects.
+const diffToSpliceOp = (before, after) => {
+  if (before === after) return null;
+  let start = 0;
+  const maxPrefix = Math.min(before.length, after.length);
+  while (start < maxPrefix && before.charCodeAt(start) === after.charCodeAt(start)) start++;
+  let endBefore = before.length;
+  let endAfter = after.length;
+  while (endBefore > start && endAfter > start && before.charCodeAt(endBefore - 1) === after.charCodeAt(endAfter - 1)) {
+    endBefore--;
+    endAfter--;
+  }
+  return { start, delete: endBefore - start, insert: after.slice(start, endAfter) };
+};
+
 // --- Editor Toolbar (Reused) ---
 const EditorToolbar = ({ editor, onBack }) => {
   const { api } = useAuth();
@@ -345,6 +361,8 @@ export const Notes = () => {
   const editorRef = useRef(null);
   const notesRef = useRef(notes);
   const noteDetailsCacheRef = useRef(new Map());
+  // Last content/revision the server confirmed per note; base for content patches
+  const savedContentRef = useRef(new Map());
 
   useEffect(() => { notesRef.current = notes; }, [notes]);
 
@@ -586,6 +604,9 @@ export const Notes = () => {
     [notes, deleteDialogNoteId]);
 
   useEffect(() => {
+    if (selectedNote && typeof selectedNote.content === 'string' && !savedContentRef.current.has(selectedNote.id)) {
+      savedContentRef.current.set(selectedNote.id, { content: selectedNote.content, revision: selectedNote.revision ?? 0 });
+    }
     if (editor && selectedNote && editor.getHTML() !== selectedNote.content) {
       editor.commands.setContent(selectedNote.content);
     }
@@ -657,10 +678,39 @@ export const Notes = () => {
     // Optimistic update
     setNotes(prev => prev.map(n => n.id === targetId ? { ...n, content } : n));
 
+    const saved = savedContentRef.current.get(targetId);
+    const op = saved ? diffToSpliceOp(saved.content, content) : undefined;
+    if (op === null) return;
+
     try {
-      await api.put(`/notes/${targetId}`, { content });
-    } catch {
-      toast.error("Failed to save changes. Check connection.");
+      let baseRevision = saved?.revision;
+      let conflicted = false;
+      if (op) {
+        try {
+          const res = await api.patch(`/notes/${targetId}/content`, { base_revision: saved.revision, ops: [op] });
+          savedContentRef.current.set(targetId, { content, revision: res.data.revision });
+          return;
+        } catch (e) {
+          // Stale base revision: reload the server copy, then save the whole document over it
+          if (e.response?.status !== 409) throw e;
+          const fresh = await api.get(`/notes/${targetId}`);
+          baseRevision = fresh.data.revision ?? 0;
+          savedContentRef.current.set(targetId, { content: fresh.data.content, revision: baseRevision });
+          conflicted = true;
+        }
+      }
+      const res = await api.put(`/notes/${targetId}`,
+        baseRevision === undefined ? { content } : { content, base_revision: baseRevision });
+      savedContentRef.current.set(targetId, { content, revision: res.data.revision ?? 0 });
+      if (conflicted) {
+        toast.info('This page was changed elsewhere; your version replaced it.');
+      }
+    } catch (e) {
+      if (e.response?.status === 409) {
+        toast.error('This page keeps changing elsewhere. Reload it before editing.');
+      } else {
+        toast.error("Failed to save changes. Check connection.");
+      }
     }
   }, [api, selectedNoteId]);
 